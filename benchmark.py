@@ -0,0 +1,73 @@
+import argparse
+import json
+import logging
+import time
+
+from util import DATA_KEY, DOC_KEY, TITLE_KEY, CONTEXT_KEY, prepare_kv, prepare_win, to_entities, load_clicr_win, \
+    build_vocab, collect_stats, calculate_parameter_values, vectorize_data_clicr_win
+
+
+def clicr_docs(fn, max_n_load=None):
+    with open(fn) as f:
+        data = json.load(f)[DATA_KEY]
+    return [datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY] for datum in data[:max_n_load]]
+
+
+def bench_scan(args):
+    """
+    Window extraction and entity joining of CliCR documents.
+    """
+    docs = clicr_docs(args.file, args.max_n_load)
+
+    def run():
+        for doc_txt in docs:
+            prepare_win(doc_txt, win_size=args.win_size, anonymize=True)
+            prepare_kv(doc_txt, win_size=args.win_size)
+            " ".join(to_entities(sent) for sent in doc_txt.split("\n") if sent)
+
+    return run, "{} docs".format(len(docs))
+
+
+def bench_vectorize(args):
+    """
+    Vectorization of one batch of CliCR window instances.
+    """
+    data = load_clicr_win(args.file, max_n_load=args.max_n_load, win_size=args.win_size, anonymize=True)
+    stats = collect_stats(data)
+    memory_size, _, word_idx, output_size, output_idx = calculate_parameter_values(
+        stats, False, args.memory_size, build_vocab([data]), logging.getLogger(__name__))
+    sentence_size = max(stats.query_size, stats.sentence_size)
+    batch = (data * (args.batch_size // len(data) + 1))[:args.batch_size]
+
+    def run():
+        vectorize_data_clicr_win(batch, word_idx, output_size, output_idx, sentence_size, memory_size)
+
+    return run, "batch size {}".format(len(batch))
+
+
+BENCHMARKS = {"scan": bench_scan, "vectorize": bench_vectorize}
+
+
+def timeit(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the data preparation steps. Run against different versions "
+                                                 "of util.py to compare them.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--benchmark", type=str, default="scan", choices=sorted(BENCHMARKS))
+    parser.add_argument("--file", type=str, help="Input file, e.g. a CliCR split.")
+    parser.add_argument("--max-n-load", type=int, help="Maximum number of documents to use.")
+    parser.add_argument("--memory-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5, help="Best of this many runs is reported.")
+    parser.add_argument("--win-size", type=int, default=3)
+    args = parser.parse_args()
+
+    run, desc = BENCHMARKS[args.benchmark](args)
+    print("{} ({}): {:.4f}s".format(args.benchmark, desc, timeit(run, args.repeat)))
@@ -4,7 +4,6 @@ from datetime import datetime
 import os
 
 import torch
-from torch.autograd import Variable
 from torch.nn.utils import clip_grad_norm_
 import matplotlib as mpl
 mpl.use('Agg')
@@ -14,15 +13,15 @@ from tqdm import tqdm
 
 from logger import get_logger
 from net import N2N, KVN2N, KVAtt, QueryClassifier
-from util import long_tensor_type, vectorize_data_clicr, vectorized_batches, vectorize_data, evaluate_clicr, save_json, \
+from util import vectorize_data_clicr, vectorized_batches, vectorize_data, evaluate_clicr, save_json, \
     get_q_ids_clicr, remove_missing_preds, deentitize, process_data_clicr_kv, vectorized_batches_kv, \
     vectorize_data_clicr_kv, process_data_cbt_kv, process_data_cbt_win, vectorize_data_cbt_win, vectorized_batches_win, \
-    process_data_clicr_win, vectorize_data_clicr_win
-from util import process_data, process_data_clicr
+    process_data_clicr_win, vectorize_data_clicr_win, vectorize_set, bucket_batches
+from util import process_data, process_data_clicr, save_vocab
 
 
 
-def train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx, sentence_size,
+def train_network(data, val_data, test_data, word_idx, sentence_size,
                   vocab_size, story_size, output_size, output_idx, save_model_path, args, log, max_inspect=15):
     if args.inspect:
         inv_output_idx = {v: k for k, v in output_idx.items()}
@@ -33,7 +32,7 @@ def train_network(train_batches_id, val_batches_id, test_batches_id, data, val_d
     elif args.mode == "queryclassifier":
         net = QueryClassifier(args.batch_size, args.embed_size, vocab_size, args=args, word_idx=word_idx, output_size=output_size)
     else:
-        net = N2N(args.batch_size, args.embed_size, vocab_size, args.hops, story_size=story_size, args=args, word_idx=word_idx, output_size=output_size, no_aggregate=args.no_aggregate, use_att_feat=args.use_att_feat, hard_att_feat=args.hard_att_feat, att_only_out=args.att_only_out)
+        net = N2N(args.batch_size, args.embed_size, vocab_size, args.hops, story_size=story_size, args=args, word_idx=word_idx, output_size=output_size, no_aggregate=args.no_aggregate, use_att_feat=args.use_att_feat, hard_att_feat=args.hard_att_feat, att_only_out=args.att_only_out, output_idx=output_idx)
         if args.mode == "win":
             positional = False
 
@@ -66,28 +65,35 @@ def train_network(train_batches_id, val_batches_id, test_batches_id, data, val_d
             vectorizer = vectorize_data_cbt_win
     else:
         raise NotImplementedError
+    # vectorized once, the batches are slices
+    train_set = vectorize_set(data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                              shard_dir=args.shard_dir, name="train", log=log)
+    val_set = vectorize_set(val_data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                            shard_dir=args.shard_dir, name="val", log=log)
+    # padded per batch; word positions only when they are not position-encoded
+    trim_words = not positional
+    train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size)
+    val_batches_id = bucket_batches(val_set.memory_lengths(), args.batch_size)
 
     running_loss = 0.0
     best_val_acc_yet = 0.0
     for current_epoch in range(args.epochs):
         if args.inspect:
             n_inspect = 0
+        if args.shuffle:
+            train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size, shuffle=True)
         if args.mode == "standard":
-            train_batch_gen = vectorized_batches(train_batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer, shuffle=args.shuffle)
+            train_batch_gen = vectorized_batches(train_batches_id, train_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
         elif args.mode == "kv":
-            k_size = sentence_size
-            train_batch_gen = vectorized_batches_kv(train_batches_id, data, word_idx, k_size, story_size,
-                                                    output_size, output_idx, vectorizer, shuffle=args.shuffle)
+            train_batch_gen = vectorized_batches_kv(train_batches_id, train_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
         elif args.mode == "win" or args.mode == "queryclassifier":
-            win_size = sentence_size
-            train_batch_gen = vectorized_batches_win(train_batches_id, data, word_idx, win_size, story_size,
-                                                     output_size, output_idx, vectorizer, shuffle=args.shuffle)
+            train_batch_gen = vectorized_batches_win(train_batches_id, train_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
         current_len = 0
         current_correct = 0
         #if args.inspect:
         #    all_att_max = []
         print("training...")
-        for batch, (s_batch, _) in tqdm(zip(train_batch_gen, train_batches_id), total=len(train_batches_id)):
+        for batch, ids in tqdm(zip(train_batch_gen, train_batches_id), total=len(train_batches_id)):
             if args.mode == "kv":
                 idx_out, idx_true, out, att_probs = epoch_kv(batch, net, args.inspect, positional)
             else:
@@ -111,16 +117,14 @@ def train_network(train_batches_id, val_batches_id, test_batches_id, data, val_d
         if current_epoch % args.log_epochs == 0:
             accuracy = 100 * (current_correct / current_len)
             if args.mode == "kv":
-                val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kv(net, val_batches_id, val_data, word_idx, sentence_size, story_size,
-                                                                    output_size, output_idx, vectorizer, args.inspect, positional)
+                val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kv(net, val_batches_id, val_set, args.inspect, positional, trim_words,
+                                                                           workers=args.prefetch_workers, depth=args.prefetch_depth)
             elif args.mode == "win" or args.mode == "queryclassifier":
-                val_acc, val_cor, val_tot = calculate_loss_and_accuracy_win(net, val_batches_id, val_data, word_idx,
-                                                                           sentence_size, story_size,
-                                                                           output_size, output_idx, vectorizer, args.inspect)
+                val_acc, val_cor, val_tot = calculate_loss_and_accuracy_win(net, val_batches_id, val_set, args.inspect, positional, trim_words,
+                                                                            workers=args.prefetch_workers, depth=args.prefetch_depth)
             else:
-                val_acc, val_cor, val_tot = calculate_loss_and_accuracy(net, val_batches_id, val_data, word_idx,
-                                                                    sentence_size, story_size,
-                                                                    output_size, output_idx, vectorizer, args.inspect)
+                val_acc, val_cor, val_tot = calculate_loss_and_accuracy(net, val_batches_id, val_set, args.inspect, positional, trim_words,
+                                                                        workers=args.prefetch_workers, depth=args.prefetch_depth)
             log.info("Epochs: {}, Train Accuracy: {:.3f}, Loss: {:.3f}, Val_Acc:{:.3f} ({}/{})".format(current_epoch, accuracy,
                                                                                 running_loss.item(),
                                                                                 val_acc, val_cor, val_tot))
@@ -143,16 +147,14 @@ def epoch(batch, net, inspect=False, positional=True):
     sentmask_batch = batch[5]
     querymask_batch = batch[6]
 
-    A = Variable(torch.stack(answer_batch, dim=0), requires_grad=False).type(long_tensor_type)
-    _, idx_true = torch.max(A, 1)
-    idx_true = torch.squeeze(idx_true)
+    idx_true = answer_batch
 
-    S = torch.stack(story_batch, dim=0)
-    Q = torch.stack(query_batch, dim=0)
-    VM = torch.stack(vocabmask_batch, dim=0) if vocabmask_batch is not None else None
-    PM = torch.stack(pasmask_batch, dim=0) if pasmask_batch is not None else None
-    SM = torch.stack(sentmask_batch, dim=0) if sentmask_batch is not None else None
-    QM = torch.stack(querymask_batch, dim=0) if querymask_batch is not None else None
+    S = story_batch
+    Q = query_batch
+    VM = vocabmask_batch
+    PM = pasmask_batch
+    SM = sentmask_batch
+    QM = querymask_batch
 
     if inspect:
         out, att_probs = net(S, Q, VM, PM, SM, QM, inspect, positional=positional)
@@ -178,17 +180,15 @@ def epoch_kv(batch, net, inspect=False, positional=True):
     keymask_batch = batch[6]
     querymask_batch = batch[7]
 
-    A = Variable(torch.stack(answer_batch, dim=0), requires_grad=False).type(long_tensor_type)
-    _, idx_true = torch.max(A, 1)
-    idx_true = torch.squeeze(idx_true)
+    idx_true = answer_batch
 
-    K = torch.stack(key_batch, dim=0)
-    V = torch.stack(value_batch, dim=0)
-    Q = torch.stack(query_batch, dim=0)
-    VM = torch.stack(vocabmask_batch, dim=0) if vocabmask_batch is not None else None
-    PM = torch.stack(pasmask_batch, dim=0) if pasmask_batch is not None else None
-    KM = torch.stack(keymask_batch, dim=0) if keymask_batch is not None else None
-    QM = torch.stack(querymask_batch, dim=0) if querymask_batch is not None else None
+    K = key_batch
+    V = value_batch
+    Q = query_batch
+    VM = vocabmask_batch
+    PM = pasmask_batch
+    KM = keymask_batch
+    QM = querymask_batch
 
     if inspect:
         out, att_probs = net(K, V, Q, VM, PM, KM, QM, inspect, positional=positional)
@@ -212,28 +212,28 @@ def count_predictions(labels, predicted):
     return batch_len, correct
 
 
-def calculate_loss_and_accuracy(net, batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer, inspect=False):
-    batch_gen = vectorized_batches(batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer)
+def calculate_loss_and_accuracy(net, batches_id, vset, inspect=False, positional=True, trim_words=True, workers=0, depth=2):
+    batch_gen = vectorized_batches(batches_id, vset, trim_words, workers=workers, depth=depth)
     current_len = 0
     current_correct = 0
     for batch in batch_gen:
-        idx_out, idx_true, out, _ = epoch(batch, net, inspect)
+        idx_out, idx_true, out, _ = epoch(batch, net, inspect, positional)
         current_correct, current_len = update_counts(current_correct, current_len, idx_out, idx_true)
     return 100 * (current_correct / current_len), current_correct, current_len
 
 
-def calculate_loss_and_accuracy_win(net, batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer, inspect=False):
-    batch_gen = vectorized_batches_win(batches_id, data, word_idx, sentence_size, story_size, output_size,  output_idx, vectorizer)
+def calculate_loss_and_accuracy_win(net, batches_id, vset, inspect=False, positional=True, trim_words=True, workers=0, depth=2):
+    batch_gen = vectorized_batches_win(batches_id, vset, trim_words, workers=workers, depth=depth)
     current_len = 0
     current_correct = 0
     for batch in batch_gen:
-        idx_out, idx_true, out, _ = epoch(batch, net, inspect)
+        idx_out, idx_true, out, _ = epoch(batch, net, inspect, positional)
         current_correct, current_len = update_counts(current_correct, current_len, idx_out, idx_true)
     return 100 * (current_correct / current_len), current_correct, current_len
 
 
-def calculate_loss_and_accuracy_kv(net, batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer, inspect=False, positional=False):
-    batch_gen = vectorized_batches_kv(batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer)
+def calculate_loss_and_accuracy_kv(net, batches_id, vset, inspect=False, positional=False, trim_words=True, workers=0, depth=2):
+    batch_gen = vectorized_batches_kv(batches_id, vset, trim_words, workers=workers, depth=depth)
     current_len = 0
     current_correct = 0
     for batch in batch_gen:
@@ -242,7 +242,7 @@ def calculate_loss_and_accuracy_kv(net, batches_id, data, word_idx, sentence_siz
     return 100 * (current_correct / current_len), current_correct, current_len
 
 
-def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_batches_id, test, log, logdir, args, cuda=0., test_q_ids=None, max_inspect=5, ignore_missing_preds=False):
+def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test, log, logdir, args, cuda=0., test_q_ids=None, max_inspect=5, ignore_missing_preds=False):
     log.info("Evaluating")
     if args.mode == "kv":
         net = KVN2N(args.batch_size, args.embed_size, vocab_size, args.hops, story_size=story_size, args=args,
@@ -252,7 +252,7 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
         net = QueryClassifier(args.batch_size, args.embed_size, vocab_size, args=args,
                   word_idx=word_idx, output_size=output_size)
     else:
-        net = N2N(args.batch_size, args.embed_size, vocab_size, args.hops, story_size=story_size, args=args, word_idx=word_idx, output_size=output_size, no_aggregate=args.no_aggregate, use_att_feat=args.use_att_feat, hard_att_feat=args.hard_att_feat, att_only_out=args.att_only_out)
+        net = N2N(args.batch_size, args.embed_size, vocab_size, args.hops, story_size=story_size, args=args, word_idx=word_idx, output_size=output_size, no_aggregate=args.no_aggregate, use_att_feat=args.use_att_feat, hard_att_feat=args.hard_att_feat, att_only_out=args.att_only_out, output_idx=output_idx)
         if args.mode == "win":
             positional = False
     net.load_state_dict(torch.load(model))
@@ -283,16 +283,16 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
             vectorizer = vectorize_data_cbt_win
     else:
         raise NotImplementedError
+    test_set = vectorize_set(test, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                             shard_dir=args.shard_dir, name="test", log=log)
+    trim_words = not positional
+    test_batches_id = bucket_batches(test_set.memory_lengths(), args.batch_size)
     if args.mode == "standard":
-        test_batch_gen = vectorized_batches(test_batches_id, test, word_idx, sentence_size, story_size, output_size,
-                                             output_idx, vectorizer, shuffle=args.shuffle)
+        test_batch_gen = vectorized_batches(test_batches_id, test_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
     elif args.mode == "kv":
-        k_size = sentence_size
-        test_batch_gen = vectorized_batches_kv(test_batches_id, test, word_idx, k_size, story_size,
-                                                output_size, output_idx, vectorizer, shuffle=args.shuffle)
+        test_batch_gen = vectorized_batches_kv(test_batches_id, test_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
     elif args.mode == "win" or args.mode == "queryclassifier":
-        test_batch_gen = vectorized_batches_win(test_batches_id, test, word_idx, sentence_size, story_size, output_size,
-                                                output_idx, vectorizer, shuffle=args.shuffle)
+        test_batch_gen = vectorized_batches_win(test_batches_id, test_set, trim_words, workers=args.prefetch_workers, depth=args.prefetch_depth)
 
     current_len = 0
     current_correct = 0
@@ -301,29 +301,29 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
         all_flat_att_ws = []
     preds = {} if args.dataset == "clicr" else None
 
-    for batch, (s_batch, _) in zip(test_batch_gen, test_batches_id):
+    for batch, ids in zip(test_batch_gen, test_batches_id):
         if args.mode == "kv":
             idx_out, idx_true, out, att_probs = epoch_kv(batch, net, args.inspect, positional)
         else:
             idx_out, idx_true, out, (att_probs, flat_att_ws) = epoch(batch, net, args.inspect, positional)
         if args.inspect:# and n_inspect < max_inspect:
             if args.mode == "kv":
-                inspect_kv(out, idx_true, logdir, "eval", s_batch, att_probs,
+                inspect_kv(out, idx_true, logdir, "eval", ids[0], att_probs,
                            inv_output_idx, test, args, log)
             elif args.mode == "win" or args.mode == "queryclassifier":
                 all_att_max.extend(list(att_probs.max(dim=1)[0].detach().cpu().numpy()))
                 all_flat_att_ws.extend(flat_att_ws)
             else:
-                inspect(out, idx_true, logdir, "eval", s_batch, att_probs,
+                inspect(out, idx_true, logdir, "eval", ids[0], att_probs,
                         inv_output_idx, test, args, log)
             n_inspect += 1
         if preds is not None:
             for c, i in enumerate(idx_out):
                 # {query_id: answer}
                 if args.anonymize:
-                    q_id, inv_entity_dict = test[s_batch + c][5]
+                    q_id, inv_entity_dict = test[ids[c]][5]
                 else:
-                    q_id = test[s_batch + c][5]
+                    q_id = test[ids[c]][5]
                 ans_pred = inv_output_idx[i.item()]
                 if args.anonymize:
                     ans_pred = inv_entity_dict[ans_pred]
@@ -363,6 +363,10 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
     log.info("Accuracy : {}".format(accuracy))
 
 
+def vocab_path(dir):
+    return os.path.join(dir, "vocab.json")
+
+
 def model_path(dir, args):
     if args.joint_training == 1:
         saved_model_filename = "joint_model.model"
@@ -434,11 +438,13 @@ def main():
     arg_parser.add_argument("--att-only-out", action="store_true")
     arg_parser.add_argument("--average-embs", type=int, default=1, help="Flag to average context embs instead of summing.")
     arg_parser.add_argument("--batch-size", type=int, default=32, help="batch size for training, default: 32")
+    arg_parser.add_argument("--cache-dir", type=str,
+                            help="directory for caching the preprocessed datasets, default: no caching")
     arg_parser.add_argument("--cuda", type=int, default=0, help="train on GPU, default: 0")
     arg_parser.add_argument("--data-dir", type=str, default="./data/en",
                             help="path to folder from where data is loaded")
     arg_parser.add_argument("--dataset", type=str, help="babi | clicr | cbt")
-    arg_parser.add_argument("--dataset-part", type=str, help="For CBT dataset, which part to train and test on: NE | CN | V | P")
+    arg_parser.add_argument("--dataset-part", type=str, help="For CBT dataset, which part to train and test on: NE | CN | V | P, or several separated by commas (e.g. NE,CN,V,P) for joint training")
     arg_parser.add_argument("--debug", action="store_true", help="Flag for debugging purposes")
     arg_parser.add_argument("--embed-size", type=int, default=50, help="embedding dimensions, default: 25")
     arg_parser.add_argument("--ent-setup", type=str, default="ent", help="How to treat entities in CliCR.")
@@ -455,17 +461,30 @@ def main():
     arg_parser.add_argument("--inspect", action="store_true", help="Flag to inspect attention and output distribution.")
     arg_parser.add_argument("--joint-training", type=int, default=0, help="joint training flag, default: 0")
     arg_parser.add_argument("--load-model-path", type=str, help="File path for the model.")
+    arg_parser.add_argument("--load-vocab", type=str,
+                            help="vocabulary file (vocab.json) saved by a training run, used instead of building the "
+                                 "vocabulary from the data; eval-only runs use the one next to the model if present")
     arg_parser.add_argument("--log-epochs", type=int, default=4,
                             help="Number of epochs after which to log progress, default: 4")
     arg_parser.add_argument("--lr", type=float, default=0.01, help="learning rate, default: 0.01")
     arg_parser.add_argument("--max-vocab-size", type=int, help="maximum number of words to keep, the rest is mapped to _UNK_")
     arg_parser.add_argument("--max-n-load", type=int, help="maximum number of clicr documents to use, for debugging")
     arg_parser.add_argument("--memory-size", type=int, default=50, help="upper limit on memory size, default: 50")
+    arg_parser.add_argument("--min-freq", type=int, default=1,
+                            help="minimum frequency of words to keep, the rest is mapped to _UNK_, default: 1")
     arg_parser.add_argument("--mode", type=str, default="standard", help="standard | kv | win | queryclassifier")
+    arg_parser.add_argument("--n-workers", type=int, default=1,
+                            help="number of processes for preprocessing CliCR/CBT documents in win mode, default: 1")
     arg_parser.add_argument("--no-aggregate", action="store_true")
+    arg_parser.add_argument("--prefetch-depth", type=int, default=2,
+                            help="number of batches prepared ahead of the one in use, with --prefetch-workers")
+    arg_parser.add_argument("--prefetch-workers", type=int, default=0,
+                            help="number of threads preparing batches while the model trains, default: 0 (none)")
     arg_parser.add_argument("--pretrained-word-embed", type=str,
                             help="path to the txt file with word embeddings")  # "/nas/corpora/accumulate/clicr/embeddings/4bfb98c2-688e-11e7-aa74-901b0e5592c8/embeddings"
     arg_parser.add_argument("--save-model", action="store_true")
+    arg_parser.add_argument("--shard-dir", type=str,
+                            help="directory to keep the vectorized datasets in as memory-mapped files, default: none (in memory)")
     arg_parser.add_argument("--shuffle", action="store_true")
     arg_parser.add_argument("--task-number", type=int, default=19, help="Babi task to process, default: 19 path finding")
     arg_parser.add_argument("--train", type=int, default=1)
@@ -498,6 +517,9 @@ def main():
     #else:
     #    log_inspect = None
 
+    if args.train == 0 and args.load_vocab is None and os.path.exists(vocab_path(logdir)):
+        args.load_vocab = vocab_path(logdir)
+
     for argk, argv in sorted(vars(args).items()):
         log.info("{}: {}".format(argk, argv))
     log.info("")
@@ -508,24 +530,15 @@ def main():
         if args.mode == "standard":
             # load data
             data, val_data, test_data, sentence_size, vocab_size, story_size, word_idx, output_size, output_idx = process_data_clicr(args, log=log)
+            if args.train == 1:
+                save_vocab(vocab_path(logdir), word_idx, output_idx)
             if args.pretrained_word_embed:
                 log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
             else:
                 log.info("Using random initialization.")
-            # get batch indices
-            # TODO: don't leave out instances
-            n_train = len(data)
-            n_val = len(val_data)
-            n_test = len(test_data)
-            train_batches_id = list(
-                zip(range(0, n_train - args.batch_size, args.batch_size), range(args.batch_size, n_train, args.batch_size)))
-            val_batches_id = list(
-                zip(range(0, n_val - args.batch_size, args.batch_size), range(args.batch_size, n_val, args.batch_size)))
-            test_batches_id = list(
-                zip(range(0, n_test - args.batch_size, args.batch_size), range(args.batch_size, n_test, args.batch_size)))
 
             if args.train == 1:
-                train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+                train_network(data, val_data, test_data, word_idx,
                               sentence_size, story_size=story_size,
                               vocab_size=vocab_size, output_size=output_size, output_idx=output_idx, save_model_path=save_model_path, args=args, log=log)
             if args.eval == 1:
@@ -533,27 +546,18 @@ def main():
                     model = save_model_path
                 else:
                     model = args.load_model_path
-                eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_batches_id, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds)
+                eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds)
         elif args.mode == "kv":
             # load data
             data, val_data, test_data, k_size, v_size, vocab_size, story_size, word_idx, output_size, output_idx = process_data_clicr_kv(args, log=log)
+            if args.train == 1:
+                save_vocab(vocab_path(logdir), word_idx, output_idx)
             if args.pretrained_word_embed:
                 log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
             else:
                 log.info("Using random initialization.")
-            # get batch indices
-            # TODO: don't leave out instances
-            n_train = len(data)
-            n_val = len(val_data)
-            n_test = len(test_data)
-            train_batches_id = list(
-                zip(range(0, n_train - args.batch_size, args.batch_size), range(args.batch_size, n_train, args.batch_size)))
-            val_batches_id = list(
-                zip(range(0, n_val - args.batch_size, args.batch_size), range(args.batch_size, n_val, args.batch_size)))
-            test_batches_id = list(
-                zip(range(0, n_test - args.batch_size, args.batch_size), range(args.batch_size, n_test, args.batch_size)))
             if args.train == 1:
-                train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+                train_network(data, val_data, test_data, word_idx,
                               k_size, story_size=story_size,
                               vocab_size=vocab_size, output_size=output_size, output_idx=output_idx, save_model_path=save_model_path, args=args, log=log)
             if args.eval == 1:
@@ -561,34 +565,23 @@ def main():
                     model = save_model_path
                 else:
                     model = args.load_model_path
-                eval_network(vocab_size, story_size, k_size, model, word_idx, output_size, output_idx, test_batches_id, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds)
+                eval_network(vocab_size, story_size, k_size, model, word_idx, output_size, output_idx, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds)
         elif args.mode == "win" or args.mode == "queryclassifier":
             # load data
             data, val_data, test_data, sentence_size, vocab_size, story_size, word_idx, output_size, output_idx = process_data_clicr_win(
                 args, log=log)
+            if args.train == 1:
+                save_vocab(vocab_path(logdir), word_idx, output_idx)
             if args.pretrained_word_embed:
                 log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
             else:
                 log.info("Using random initialization.")
-            # get batch indices
-            # TODO: don't leave out instances
-            n_train = len(data)
-            n_val = len(val_data)
-            n_test = len(test_data)
-            train_batches_id = list(
-                zip(range(0, n_train - args.batch_size, args.batch_size),
-                    range(args.batch_size, n_train, args.batch_size)))
-            val_batches_id = list(
-                zip(range(0, n_val - args.batch_size, args.batch_size), range(args.batch_size, n_val, args.batch_size)))
-            test_batches_id = list(
-                zip(range(0, n_test - args.batch_size, args.batch_size),
-                    range(args.batch_size, n_test, args.batch_size)))
             if args.train == 1:
-                #train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+                #train_network(data, val_data, test_data, word_idx,
                 #              sentence_size, story_size=story_size,
                 #              vocab_size=vocab_size, output_size=vocab_size, output_idx=None,
                 #              save_model_path=save_model_path, args=args, log=log)
-                train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+                train_network(data, val_data, test_data, word_idx,
                               sentence_size, story_size=story_size,
                               vocab_size=vocab_size, output_size=output_size, output_idx=output_idx,
                               save_model_path=save_model_path, args=args, log=log)
@@ -597,37 +590,28 @@ def main():
                     model = save_model_path
                 else:
                     model = args.load_model_path
-                #eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None, test_batches_id,
+                #eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None,
                 #             test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids,
                 #             ignore_missing_preds=args.ignore_missing_preds)
-                eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_batches_id,
+                eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx,
                              test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids,
                              ignore_missing_preds=args.ignore_missing_preds)
 
     elif args.dataset == "cbt":
-        if args.dataset_part not in {"NE","CN","V","P"}:
+        if not args.dataset_part or not set(args.dataset_part.split(",")) <= {"NE","CN","V","P"}:
             sys.exit("Invalid dataset part specified for CBT.")
         if args.mode == "win" or args.mode == "queryclassifier":
             # load data
             data, val_data, test_data, sentence_size, vocab_size, story_size, word_idx = process_data_cbt_win(
                 args, log=log)
+            if args.train == 1:
+                save_vocab(vocab_path(logdir), word_idx)
             if args.pretrained_word_embed:
                 log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
             else:
                 log.info("Using random initialization.")
-            # get batch indices
-            # TODO: don't leave out instances
-            n_train = len(data)
-            n_val = len(val_data)
-            n_test = len(test_data)
-            train_batches_id = list(
-                zip(range(0, n_train - args.batch_size, args.batch_size), range(args.batch_size, n_train, args.batch_size)))
-            val_batches_id = list(
-                zip(range(0, n_val - args.batch_size, args.batch_size), range(args.batch_size, n_val, args.batch_size)))
-            test_batches_id = list(
-                zip(range(0, n_test - args.batch_size, args.batch_size), range(args.batch_size, n_test, args.batch_size)))
             if args.train == 1:
-                train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+                train_network(data, val_data, test_data, word_idx,
                               sentence_size, story_size=story_size,
                               vocab_size=vocab_size, output_size=vocab_size, output_idx=None,
                               save_model_path=save_model_path, args=args, log=log)
@@ -636,26 +620,17 @@ def main():
                     model = save_model_path
                 else:
                     model = args.load_model_path
-                eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None, test_batches_id,
+                eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None,
                              test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids,
                              ignore_missing_preds=args.ignore_missing_preds)
 
     elif args.dataset == "babi":
         data, val_data, test_data, sentence_size, vocab_size, story_size, word_idx = process_data(args, log=log)
-        # get batch indices
-        # TODO: don't leave out instances
-        n_train = len(data)
-        n_val = len(val_data)
-        n_test = len(test_data)
-        train_batches_id = list(zip(range(0, n_train - args.batch_size, args.batch_size),
-                                    range(args.batch_size, n_train, args.batch_size)))
-        val_batches_id = list(zip(range(0, n_val - args.batch_size, args.batch_size),
-                                   range(args.batch_size, n_val, args.batch_size)))
-        test_batches_id = list(zip(range(0, n_test - args.batch_size, args.batch_size),
-                                   range(args.batch_size, n_test, args.batch_size)))
+        if args.train == 1:
+            save_vocab(vocab_path(logdir), word_idx)
         if args.train == 1:
             print("dbg: for babi val=test")
-            train_network(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+            train_network(data, val_data, test_data, word_idx,
                           sentence_size, story_size=story_size,
                           vocab_size=vocab_size, output_size=vocab_size, output_idx=None, save_model_path=save_model_path, args=args, log=log)
 
@@ -664,7 +639,7 @@ def main():
                 model = save_model_path
             else:
                 model = args.load_model_path
-            eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None, test_batches_id,
+            eval_network(vocab_size, story_size, sentence_size, model, word_idx, vocab_size, None,
                          test_data, log, logdir, args, cuda=args.cuda)
     else:
         raise ValueError
@@ -3,19 +3,18 @@ from datetime import datetime
 import os
 
 import torch
-from torch.autograd import Variable
 from torch.nn.utils import clip_grad_norm_
 import numpy as np
 
 from logger import get_logger
 from net import N2N, KVN2N, KVAtt
-from util import long_tensor_type, vectorize_data_clicr, vectorized_batches, vectorize_data, evaluate_clicr, save_json, \
+from util import vectorize_data_clicr, vectorized_batches, vectorize_data, evaluate_clicr, save_json, \
     get_q_ids_clicr, remove_missing_preds, deentitize, process_data_clicr_kv, vectorized_batches_kv, \
-    vectorize_data_clicr_kv, vectorize_data_clicr_kvatt, process_data_kv, vectorize_data_kvatt
-from util import process_data, process_data_clicr
+    vectorize_data_clicr_kv, vectorize_data_clicr_kvatt, process_data_kv, vectorize_data_kvatt, vectorize_set, bucket_batches
+from util import process_data, process_data_clicr, save_vocab
 
 
-def train_network_kvatt(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx, sentence_size,
+def train_network_kvatt(data, val_data, test_data, word_idx, sentence_size,
                   vocab_size, story_size, output_size, output_idx, save_model_path, args, log, attention_sum):
 
     net = KVAtt(args.batch_size, args.embed_size, vocab_size, story_size=story_size, args=args,
@@ -29,15 +28,22 @@ def train_network_kvatt(train_batches_id, val_batches_id, test_batches_id, data,
         optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
         optimizer.zero_grad()
     vectorizer = vectorize_data_clicr_kvatt
+    # vectorized once, the batches are slices
+    train_set = vectorize_set(data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                              shard_dir=args.shard_dir, name="train", log=log)
+    val_set = vectorize_set(val_data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                            shard_dir=args.shard_dir, name="val", log=log)
+    train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size)
+    val_batches_id = bucket_batches(val_set.memory_lengths(), args.batch_size)
     running_loss = 0.0
     best_val_acc_yet = 0.0
     for current_epoch in range(args.epochs):
-        k_size = sentence_size
-        train_batch_gen = vectorized_batches_kv(train_batches_id, data, word_idx, k_size, story_size,
-                                                 output_size, output_idx, vectorizer, shuffle=args.shuffle)
+        if args.shuffle:
+            train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size, shuffle=True)
+        train_batch_gen = vectorized_batches_kv(train_batches_id, train_set, workers=args.prefetch_workers, depth=args.prefetch_depth)
         current_len = 0
         current_correct = 0
-        for batch, (s_batch, _) in zip(train_batch_gen, train_batches_id):
+        for batch in train_batch_gen:
             idx_out, idx_true, out, att_probs = epoch_kvatt(batch, net, args.inspect, positional, attention_sum)
             current_correct, current_len = update_counts(current_correct, current_len, idx_out, idx_true)
             if not args.freeze_pretrained_word_embed:
@@ -51,8 +57,8 @@ def train_network_kvatt(train_batches_id, val_batches_id, test_batches_id, data,
             if current_epoch % args.log_epochs == 0:
                 accuracy = 100 * (current_correct / current_len)
                 if args.mode == "kv":
-                    val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_data, word_idx, sentence_size, story_size,
-                                                                        output_size, output_idx, vectorizer, args.inspect, positional, attention_sum)
+                    val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_set, args.inspect, positional, attention_sum,
+                                                                                  workers=args.prefetch_workers, depth=args.prefetch_depth)
                 log.info("Epochs: {}, Train Accuracy: {:.3f}, Loss: {:.3f}, Val_Acc:{:.3f} ({}/{})".format(current_epoch, accuracy,
                                                                                     running_loss.item(),
                                                                                     val_acc, val_cor, val_tot))
@@ -65,7 +71,7 @@ def train_network_kvatt(train_batches_id, val_batches_id, test_batches_id, data,
                     param_group['lr'] = param_group['lr'] / args.anneal_factor
             running_loss = 0.0
 
-def train_network_kvatt_babi(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx, sentence_size,
+def train_network_kvatt_babi(data, val_data, test_data, word_idx, sentence_size,
                   vocab_size, story_size, output_size, output_idx, save_model_path, args, log, attention_sum):
 
     net = KVAtt(args.batch_size, args.embed_size, vocab_size, story_size=story_size, args=args,
@@ -79,15 +85,22 @@ def train_network_kvatt_babi(train_batches_id, val_batches_id, test_batches_id,
         optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
         optimizer.zero_grad()
     vectorizer = vectorize_data_kvatt
+    # vectorized once, the batches are slices
+    train_set = vectorize_set(data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                              shard_dir=args.shard_dir, name="train", log=log)
+    val_set = vectorize_set(val_data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                            shard_dir=args.shard_dir, name="val", log=log)
+    train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size)
+    val_batches_id = bucket_batches(val_set.memory_lengths(), args.batch_size)
     running_loss = 0.0
     best_val_acc_yet = 0.0
     for current_epoch in range(args.epochs):
-        k_size = sentence_size
-        train_batch_gen = vectorized_batches_kv(train_batches_id, data, word_idx, k_size, story_size,
-                                                 output_size, output_idx, vectorizer, shuffle=args.shuffle)
+        if args.shuffle:
+            train_batches_id = bucket_batches(train_set.memory_lengths(), args.batch_size, shuffle=True)
+        train_batch_gen = vectorized_batches_kv(train_batches_id, train_set, workers=args.prefetch_workers, depth=args.prefetch_depth)
         current_len = 0
         current_correct = 0
-        for batch, (s_batch, _) in zip(train_batch_gen, train_batches_id):
+        for batch in train_batch_gen:
             idx_out, idx_true, out, att_probs = epoch_kvatt(batch, net, args.inspect, positional, attention_sum)
             current_correct, current_len = update_counts(current_correct, current_len, idx_out, idx_true)
             if not args.freeze_pretrained_word_embed:
@@ -101,8 +114,8 @@ def train_network_kvatt_babi(train_batches_id, val_batches_id, test_batches_id,
             if current_epoch % args.log_epochs == 0:
                 accuracy = 100 * (current_correct / current_len)
                 if args.mode == "kv":
-                    val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_data, word_idx, sentence_size, story_size,
-                                                                        output_size, output_idx, vectorizer, args.inspect, positional, attention_sum)
+                    val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_set, args.inspect, positional, attention_sum,
+                                                                                  workers=args.prefetch_workers, depth=args.prefetch_depth)
                 log.info("Epochs: {}, Train Accuracy: {:.3f}, Loss: {:.3f}, Val_Acc:{:.3f} ({}/{})".format(current_epoch, accuracy,
                                                                                     running_loss.item(),
                                                                                     val_acc, val_cor, val_tot))
@@ -116,10 +129,9 @@ def train_network_kvatt_babi(train_batches_id, val_batches_id, test_batches_id,
             running_loss = 0.0
         else:
             accuracy = 100 * (current_correct / current_len)
-            val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_data, word_idx,
-                                                                          sentence_size, story_size,
-                                                                          output_size, output_idx, vectorizer,
-                                                                          args.inspect, positional, attention_sum)
+            val_acc, val_cor, val_tot = calculate_loss_and_accuracy_kvatt(net, val_batches_id, val_set, args.inspect,
+                                                                          positional, attention_sum,
+                                                                          workers=args.prefetch_workers, depth=args.prefetch_depth)
             log.info("Train Accuracy: {:.3f}, Val_Acc:{:.3f} ({}/{})".format(accuracy, val_acc, val_cor, val_tot))
 
 
@@ -133,17 +145,15 @@ def epoch_kvatt(batch, net, inspect=False, positional=True, attention_sum=False)
     keymask_batch = batch[6]
     querymask_batch = batch[7]
 
-    A = Variable(torch.stack(answer_batch, dim=0), requires_grad=False).type(long_tensor_type)
-    _, idx_true = torch.max(A, 1)
-    idx_true = torch.squeeze(idx_true)
+    idx_true = answer_batch
 
-    K = torch.stack(key_batch, dim=0)
-    V = torch.stack(value_batch, dim=0)
-    Q = torch.stack(query_batch, dim=0)
-    VM = torch.stack(vocabmask_batch, dim=0) if vocabmask_batch is not None else None
-    PM = torch.stack(pasmask_batch, dim=0) if pasmask_batch is not None else None
-    KM = torch.stack(keymask_batch, dim=0) if keymask_batch is not None else None
-    QM = torch.stack(querymask_batch, dim=0) if querymask_batch is not None else None
+    K = key_batch
+    V = value_batch
+    Q = query_batch
+    VM = vocabmask_batch
+    PM = pasmask_batch
+    KM = keymask_batch
+    QM = querymask_batch
 
     out, idx_out, att_probs = net(K, V, Q, VM, PM, KM, QM, inspect, positional=positional, attention_sum=attention_sum)
 
@@ -162,8 +172,8 @@ def count_predictions(labels, predicted):
     return batch_len, correct
 
 
-def calculate_loss_and_accuracy_kvatt(net, batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer, inspect=False, positional=False, attention_sum=False):
-    batch_gen = vectorized_batches_kv(batches_id, data, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer)
+def calculate_loss_and_accuracy_kvatt(net, batches_id, vset, inspect=False, positional=False, attention_sum=False, workers=0, depth=2):
+    batch_gen = vectorized_batches_kv(batches_id, vset, workers=workers, depth=depth)
     current_len = 0
     current_correct = 0
     for batch in batch_gen:
@@ -172,7 +182,7 @@ def calculate_loss_and_accuracy_kvatt(net, batches_id, data, word_idx, sentence_
     return 100 * (current_correct / current_len), current_correct, current_len
 
 
-def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_batches_id, test, log, logdir, args, cuda=0., test_q_ids=None, max_inspect=5, ignore_missing_preds=False, attention_sum=False):
+def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test, log, logdir, args, cuda=0., test_q_ids=None, max_inspect=5, ignore_missing_preds=False, attention_sum=False):
     log.info("Evaluating")
     net = KVAtt(args.batch_size, args.embed_size, vocab_size, story_size=story_size, args=args,
                   word_idx=word_idx, output_size=output_size)
@@ -183,19 +193,20 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
     if torch.cuda.is_available() and cuda == 1:
         net = net.cuda()
     vectorizer = vectorize_data_clicr_kvatt
-    k_size = sentence_size
-    test_batch_gen = vectorized_batches_kv(test_batches_id, test, word_idx, k_size, story_size,
-                                                output_size, output_idx, vectorizer, shuffle=args.shuffle)
+    test_set = vectorize_set(test, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                             shard_dir=args.shard_dir, name="test", log=log)
+    test_batches_id = bucket_batches(test_set.memory_lengths(), args.batch_size)
+    test_batch_gen = vectorized_batches_kv(test_batches_id, test_set, workers=args.prefetch_workers, depth=args.prefetch_depth)
     current_len = 0
     current_correct = 0
     preds = {} if args.dataset == "clicr" else None
 
-    for batch, (s_batch, _) in zip(test_batch_gen, test_batches_id):
+    for batch, ids in zip(test_batch_gen, test_batches_id):
         idx_out, idx_true, out, att_probs = epoch_kvatt(batch, net, args.inspect, positional, attention_sum)
         if preds is not None:
             for c, i in enumerate(idx_out):
                 # {query_id: answer}
-                preds[test[s_batch+c][5]] = deentitize(inv_output_idx[i.item()])
+                preds[test[ids[c]][5]] = deentitize(inv_output_idx[i.item()])
         current_correct, current_len = update_counts(current_correct, current_len, idx_out, idx_true)
     # clicr detailed evaluation
     if args.dataset=="clicr":
@@ -219,7 +230,7 @@ def eval_network(vocab_size, story_size, sentence_size, model, word_idx, output_
     log.info("Accuracy : {}".format(accuracy))
 
 
-def eval_network_babi(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test_batches_id, test, log, logdir, args, cuda=0., max_inspect=5, ignore_missing_preds=False, attention_sum=False):
+def eval_network_babi(vocab_size, story_size, sentence_size, model, word_idx, output_size, output_idx, test, log, logdir, args, cuda=0., max_inspect=5, ignore_missing_preds=False, attention_sum=False):
     log.info("Evaluating")
     net = KVAtt(args.batch_size, args.embed_size, vocab_size, story_size=story_size, args=args,
                   word_idx=word_idx, output_size=output_size)
@@ -230,14 +241,15 @@ def eval_network_babi(vocab_size, story_size, sentence_size, model, word_idx, ou
     if torch.cuda.is_available() and cuda == 1:
         net = net.cuda()
     vectorizer = vectorize_data_kvatt
-    k_size = sentence_size
-    test_batch_gen = vectorized_batches_kv(test_batches_id, test, word_idx, k_size, story_size,
-                                                output_size, output_idx, vectorizer, shuffle=args.shuffle)
+    test_set = vectorize_set(test, word_idx, sentence_size, story_size, output_size, output_idx, vectorizer,
+                             shard_dir=args.shard_dir, name="test", log=log)
+    test_batches_id = bucket_batches(test_set.memory_lengths(), args.batch_size)
+    test_batch_gen = vectorized_batches_kv(test_batches_id, test_set, workers=args.prefetch_workers, depth=args.prefetch_depth)
     current_len = 0
     current_correct = 0
     preds = {}
 
-    for batch, (s_batch, _) in zip(test_batch_gen, test_batches_id):
+    for batch in test_batch_gen:
         idx_out, idx_true, out, att_probs = epoch_kvatt(batch, net, args.inspect, positional, attention_sum)
         if preds is not None:
             for c, i in enumerate(idx_out):
@@ -249,6 +261,10 @@ def eval_network_babi(vocab_size, story_size, sentence_size, model, word_idx, ou
     log.info("Accuracy : {}".format(accuracy))
 
 
+def vocab_path(dir):
+    return os.path.join(dir, "vocab.json")
+
+
 def model_path(dir, args):
     if args.joint_training == 1:
         saved_model_filename = "joint_model.model"
@@ -270,6 +286,8 @@ def main():
     arg_parser.add_argument("--attention-sum", action="store_true", help="Flag to sum attention probs for the same entity.")
     arg_parser.add_argument("--average-embs", type=int, default=1, help="Flag to average context embs instead of summing.")
     arg_parser.add_argument("--batch-size", type=int, default=32, help="batch size for training, default: 32")
+    arg_parser.add_argument("--cache-dir", type=str,
+                            help="directory for caching the preprocessed datasets, default: no caching")
     arg_parser.add_argument("--cuda", type=int, default=0, help="train on GPU, default: 0")
     arg_parser.add_argument("--data-dir", type=str, default="./data/tasks_1-20_v1-2/en",
                             help="path to folder from where data is loaded")
@@ -287,15 +305,27 @@ def main():
     arg_parser.add_argument("--inspect", action="store_true", help="Flag to inspect attention and output distribution.")
     arg_parser.add_argument("--joint-training", type=int, default=0, help="joint training flag, default: 0")
     arg_parser.add_argument("--load-model-path", type=str, help="File path for the model.")
+    arg_parser.add_argument("--load-vocab", type=str,
+                            help="vocabulary file (vocab.json) saved by a training run, used instead of building the "
+                                 "vocabulary from the data; eval-only runs use the one next to the model if present")
     arg_parser.add_argument("--log-epochs", type=int, default=4,
                             help="Number of epochs after which to log progress, default: 4")
     arg_parser.add_argument("--lr", type=float, default=0.01, help="learning rate, default: 0.01")
     arg_parser.add_argument("--max-n-load", type=int, help="maximum number of clicr documents to use, for debugging")
+    arg_parser.add_argument("--max-vocab-size", type=int, help="maximum number of words to keep, the rest is mapped to _UNK_")
     arg_parser.add_argument("--memory-size", type=int, default=50, help="upper limit on memory size, default: 50")
+    arg_parser.add_argument("--min-freq", type=int, default=1,
+                            help="minimum frequency of words to keep, the rest is mapped to _UNK_, default: 1")
     arg_parser.add_argument("--mode", type=str, default="standard", help="standard | kv")
+    arg_parser.add_argument("--prefetch-depth", type=int, default=2,
+                            help="number of batches prepared ahead of the one in use, with --prefetch-workers")
+    arg_parser.add_argument("--prefetch-workers", type=int, default=0,
+                            help="number of threads preparing batches while the model trains, default: 0 (none)")
     arg_parser.add_argument("--pretrained-word-embed", type=str,
                             help="path to the txt file with word embeddings")  # "/nas/corpora/accumulate/clicr/embeddings/4bfb98c2-688e-11e7-aa74-901b0e5592c8/embeddings"
     arg_parser.add_argument("--save-model", action="store_true")
+    arg_parser.add_argument("--shard-dir", type=str,
+                            help="directory to keep the vectorized datasets in as memory-mapped files, default: none (in memory)")
     arg_parser.add_argument("--shuffle", action="store_true")
     arg_parser.add_argument("--task-number", type=int, default=1, help="Babi task to process, default: 1")
     arg_parser.add_argument("--train", type=int, default=1)
@@ -319,6 +349,9 @@ def main():
             os.makedirs(logdir)
         log = get_logger(logdir + "/log")
 
+    if args.train == 0 and args.load_vocab is None and os.path.exists(vocab_path(logdir)):
+        args.load_vocab = vocab_path(logdir)
+
     for argk, argv in sorted(vars(args).items()):
         log.info("{}: {}".format(argk, argv))
     log.info("")
@@ -328,23 +361,14 @@ def main():
     if args.dataset == "clicr":
         # load data
         data, val_data, test_data, k_size, v_size, vocab_size, story_size, word_idx, output_size, output_idx = process_data_clicr_kv(args, log=log)
+        if args.train == 1:
+            save_vocab(vocab_path(logdir), word_idx, output_idx)
         if args.pretrained_word_embed:
             log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
         else:
             log.info("Using random initializativectorized_batches_kvon.")
-        # get batch indices
-        # TODO: don't leave out instances
-        n_train = len(data)
-        n_val = len(val_data)
-        n_test = len(test_data)
-        train_batches_id = list(
-            zip(range(0, n_train - args.batch_size, args.batch_size), range(args.batch_size, n_train, args.batch_size)))
-        val_batches_id = list(
-            zip(range(0, n_val - args.batch_size, args.batch_size), range(args.batch_size, n_val, args.batch_size)))
-        test_batches_id = list(
-            zip(range(0, n_test - args.batch_size, args.batch_size), range(args.batch_size, n_test, args.batch_size)))
         if args.train == 1:
-            train_network_kvatt(train_batches_id, val_batches_id, test_batches_id, data, val_data, test_data, word_idx,
+            train_network_kvatt(data, val_data, test_data, word_idx,
                           k_size, story_size=story_size,
                           vocab_size=vocab_size, output_size=output_size, output_idx=output_idx, save_model_path=save_model_path, args=args, log=log, attention_sum=args.attention_sum)
         if args.eval == 1:
@@ -353,25 +377,19 @@ def main():
             else:
                 #model = args.load_model_path
                 model = None
-            eval_network(vocab_size, story_size, k_size, model, word_idx, output_size, output_idx, test_batches_id, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds, attention_sum=args.attention_sum)
+            eval_network(vocab_size, story_size, k_size, model, word_idx, output_size, output_idx, test_data, log, logdir, args, cuda=args.cuda, test_q_ids=test_q_ids, ignore_missing_preds=args.ignore_missing_preds, attention_sum=args.attention_sum)
 
     elif args.dataset == "babi":
         # load data
         data, test_data, k_size, v_size, vocab_size, story_size, word_idx = process_data_kv(args, log=log)
+        if args.train == 1:
+            save_vocab(vocab_path(logdir), word_idx)
         if args.pretrained_word_embed:
             log.info("Using pretrained word embeddings: {}".format(args.pretrained_word_embed))
         else:
             log.info("Using random initializativectorized_batches_kvon.")
-        # get batch indices
-        # TODO: don't leave out instances
-        n_train = len(data)
-        n_test = len(test_data)
-        train_batches_id = list(
-            zip(range(0, n_train - args.batch_size, args.batch_size), range(args.batch_size, n_train, args.batch_size)))
-        test_batches_id = list(
-            zip(range(0, n_test - args.batch_size, args.batch_size), range(args.batch_size, n_test, args.batch_size)))
         if args.train == 1:
-            train_network_kvatt_babi(train_batches_id, test_batches_id, test_batches_id, data, test_data, test_data, word_idx,
+            train_network_kvatt_babi(data, test_data, test_data, word_idx,
                           k_size, story_size=story_size,
                           vocab_size=vocab_size, output_size=vocab_size, output_idx=word_idx, save_model_path=save_model_path, args=args, log=log, attention_sum=args.attention_sum)
         if args.eval == 1:
@@ -380,7 +398,7 @@ def main():
             else:
                 #model = args.load_model_path
                 model = None
-            eval_network_babi(vocab_size, story_size, k_size, model, word_idx, vocab_size, word_idx, test_batches_id, test_data, log, logdir, args, cuda=args.cuda, ignore_missing_preds=args.ignore_missing_preds, attention_sum=args.attention_sum)
+            eval_network_babi(vocab_size, story_size, k_size, model, word_idx, vocab_size, word_idx, test_data, log, logdir, args, cuda=args.cuda, ignore_missing_preds=args.ignore_missing_preds, attention_sum=args.attention_sum)
 
 
 
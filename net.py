@@ -6,12 +6,53 @@ from torch import nn
 from torch.autograd import Variable
 from torch.nn import functional as F
 
-from net_util import masked_log_softmax, masked_softmax, masked_softmin
-from util import get_position_encoding, long_tensor_type, load_emb, float_tensor_type
+from net_util import cosine_scores, index_mask, masked_log_softmax, masked_softmax, masked_softmin, weighted_sum
+from util import position_encoding, long_tensor_type, load_emb, float_tensor_type, word_lookup
+
+
+class BowEncoder(nn.Module):
+    """
+    Bag-of-words encoder of the queries and memories of all models: the sum of the word embeddings, or their mean with
+    average_embs, the padding left out by the word mask. With position encoding, the embeddings are first weighted
+    by it. The encodings are built once per (length, embed_size, device) and broadcast over the batch.
+    """
+    def __init__(self, embed_size, average_embs):
+        super(BowEncoder, self).__init__()
+        self.embed_size = embed_size
+        self.average_embs = average_embs
+        self.position_encodings = {}
+
+    def position_encoding(self, length, device):
+        key = (length, self.embed_size, device)
+        if key not in self.position_encodings:
+            self.position_encodings[key] = torch.from_numpy(position_encoding(length, self.embed_size)).to(device)
+        return self.position_encodings[key]
+
+    def forward(self, ids, embedding_layer, mask, positional=True):
+        """
+        :param ids: word ids, ...*W
+        :param mask: 1 for the words, 0 for the padding, ...*W
+        :return: ...*d
+        """
+        if positional:
+            embeddings = embedding_layer(ids) * self.position_encoding(ids.size(-1), ids.device)  # one gather
+            # zero out the masked (padded) word embeddings:
+            encoded = torch.sum(embeddings * mask.unsqueeze(-1), dim=-2)
+        else:
+            # weighted by the mask, without the ...*W*d embeddings in between
+            encoded = F.embedding_bag(ids.reshape(-1, ids.size(-1)), embedding_layer.weight,
+                                      per_sample_weights=mask.reshape(-1, mask.size(-1)).type_as(embedding_layer.weight),
+                                      mode="sum").view(*ids.size()[:-1], -1)
+        if self.average_embs:
+            normalizer = torch.sum(mask, dim=-1, keepdim=True)
+            normalizer[normalizer == 0.] = float("Inf")
+            encoded = encoded / normalizer
+
+        return encoded
 
 
 class N2N(torch.nn.Module):
-    def __init__(self, batch_size, embed_size, vocab_size, hops, story_size, args, word_idx, output_size, no_aggregate, use_att_feat, hard_att_feat, att_only_out):
+    def __init__(self, batch_size, embed_size, vocab_size, hops, story_size, args, word_idx, output_size, no_aggregate, use_att_feat, hard_att_feat, att_only_out, output_idx=None):
         super(N2N, self).__init__()
 
         self.embed_size = embed_size
@@ -21,8 +62,11 @@ class N2N(torch.nn.Module):
         self.pretrained_word_embed = args.pretrained_word_embed
         self.freeze_pretrained_word_embed = args.freeze_pretrained_word_embed
         self.word_idx = word_idx
-        self.inv_word_idx = {v: k for k, v in word_idx.items()}
+        lookup = word_lookup(word_idx, output_idx)
+        self.register_buffer("output_ids", torch.from_numpy(lookup.output_ids), persistent=False)
+        self.register_buffer("is_entity", torch.from_numpy(lookup.is_entity), persistent=False)
         self.args = args
+        self.encoder = BowEncoder(embed_size, args.average_embs)
         self.output_size = output_size
         self.no_aggregate = no_aggregate
         self.use_att_feat = use_att_feat
@@ -107,7 +151,6 @@ class N2N(torch.nn.Module):
         #self.lin = nn.Linear(embed_size, embed_size)
         #self.dropout = nn.Dropout(0.5)
         #self.lin_bn = nn.BatchNorm1d(4*embed_size)
-        self.cos = nn.CosineSimilarity(dim=2)
         #self.lin = nn.Linear(embed_size*4, embed_size)
 
         if use_att_feat:
@@ -128,43 +171,35 @@ class N2N(torch.nn.Module):
 
     def forward(self, trainS, trainQ, trainVM, trainPM, trainSM, trainQM, inspect, positional=True):
         """
-        :param trainVM: a B*V tensor masking all predictions which are not words/entities in the relevant document
+        :param trainVM: (offsets, ids) of the words/entities in the relevant document, per instance; all other predictions are masked
         """
         S = Variable(trainS, requires_grad=False)
         Q = Variable(torch.squeeze(trainQ, 1), requires_grad=False)
 
-        queries_emb = self.A1(Q)
-        #queries_emb = self.B1(Q)
-
-        if positional:
-            position_encoding = get_position_encoding(queries_emb.size(0), queries_emb.size(1), self.embed_size)
-            queries = queries_emb * position_encoding
-        else:
-            queries = queries_emb
-        # zero out the masked (padded) word embeddings:
-        queries = queries * trainQM.unsqueeze(2).expand_as(queries)
-
-        queries_rep = torch.sum(queries, dim=1)
+        queries_rep = self.encoder(Q, self.A1, trainQM, positional)
+        #queries_rep = self.encoder(Q, self.B1, trainQM, positional)
         # w_u = queries_sum
         # for i in range(self.hops):
         #     w_u = self.one_hop(S, w_u, self.A[i], self.A[i + 1], self.TA[i], self.TA[i + 1])
-        if self.args.average_embs:
-            normalizer = torch.sum(trainQM, dim=1).unsqueeze(1).expand_as(queries_rep)
-            normalizer[normalizer==0.] = float("Inf")
-            queries_rep = queries_rep / normalizer
+        # the story is embedded once per table, and the embeddings are shared by the hops
+        if self.no_aggregate:  # only the attended windows are read, embedded in hop
+            mem_emb_A, = self.embed_memories(S, (self.A1,), trainSM, positional)
+            mem_emb_C = None
+        else:
+            mem_emb_A, mem_emb_C = self.embed_memories(S, (self.A1, self.A2), trainSM, positional)
         if inspect:
-            w_u, att_probs = self.hop(S, queries_rep, self.A1, self.A2, trainPM, trainSM, inspect, last_hop=self.hops == 1, positional=positional, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA2)
+            w_u, att_probs = self.hop(S, queries_rep, mem_emb_A, mem_emb_C, trainPM, inspect, C_k=self.A2, SM=trainSM, positional=positional, last_hop=self.hops == 1, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA2)
             #w_u, att_probs = self.hop(S, queries_rep, self.A1, self.A1, trainPM, trainSM, inspect)  # , self.TA, self.TA2)
         else:
-            w_u = self.hop(S, queries_rep, self.A1, self.A2, trainPM, trainSM, inspect, last_hop=self.hops == 1, positional=positional, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA2)
+            w_u = self.hop(S, queries_rep, mem_emb_A, mem_emb_C, trainPM, inspect, C_k=self.A2, SM=trainSM, positional=positional, last_hop=self.hops == 1, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA2)
             #w_u = self.hop(S, queries_rep, self.A1, self.A1, trainPM, trainSM, inspect)  # , self.TA, self.TA2)
 
         if self.hops >= 2:
             if inspect:
-                w_u, att_probs = self.hop(S, w_u, self.A1, self.A2, trainPM, trainSM, inspect, last_hop=self.hops == 1, positional=positional, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA3)
+                w_u, att_probs = self.hop(S, w_u, mem_emb_A, mem_emb_C, trainPM, inspect, C_k=self.A2, SM=trainSM, positional=positional, last_hop=self.hops == 2, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA3)
                 #w_u, att_probs = self.hop(S, w_u, self.A3, self.A3, trainPM, trainSM, inspect)  # , self.TA, self.TA3)
             else:
-                w_u = self.hop(S, w_u, self.A1, self.A2, trainPM, trainSM, inspect, last_hop=self.hops == 1, positional=positional, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA3)
+                w_u = self.hop(S, w_u, mem_emb_A, mem_emb_C, trainPM, inspect, C_k=self.A2, SM=trainSM, positional=positional, last_hop=self.hops == 2, no_aggregate=self.no_aggregate, use_att_feat=self.use_att_feat, hard_att_feat=self.hard_att_feat, att_only_out=self.att_only_out)  # , self.TA, self.TA3)
                 #w_u = self.hop(S, w_u, self.A3, self.A3, trainPM, trainSM, inspect)  # , self.TA, self.TA3)
 
         #if self.hops >= 3:
@@ -196,7 +231,7 @@ class N2N(torch.nn.Module):
         #    y_pred = y_pred * trainVM
         #return y_pred
 
-        y_pred_m = trainVM
+        y_pred_m = index_mask(trainVM, y_pred.size(1))
         #y_pred_m = None
         out = masked_log_softmax(y_pred, y_pred_m)
         if inspect:
@@ -204,62 +239,63 @@ class N2N(torch.nn.Module):
         else:
             return out
 
-    def hop(self, trainS, u_k_1, A_k, C_k, PM, SM, inspect, last_hop, positional, no_aggregate=True, use_att_feat=True, hard_att_feat=True, att_only_out=True):  # , temp_A_k, temp_C_k):
-        mem_emb_A = self.embed_story(trainS, A_k, SM, positional)
-        mem_emb_C = self.embed_story(trainS, C_k, SM, positional)
+    def embed_memories(self, trainS, tables, SM, positional):
+        """
+        :return: the embeddings of the memories with each of the tables, B*S*d; a table given twice is used once
+        """
+        embedded = {}
+        for table in tables:
+            if table not in embedded:
+                embedded[table] = self.encoder(trainS, table, SM, positional)
+        return [embedded[table] for table in tables]
 
+    def hop(self, trainS, u_k_1, mem_emb_A, mem_emb_C, PM, inspect, C_k, SM, positional, last_hop, no_aggregate=True, use_att_feat=True, hard_att_feat=True, att_only_out=True):  # , temp_A_k, temp_C_k):
+        """
+        :param mem_emb_C: the memories embedded with C_k, or None to embed only the best win of each instance (with
+        no_aggregate)
+        """
         mem_emb_A_temp = mem_emb_A  # + temp_A_k
         mem_emb_C_temp = mem_emb_C  # + temp_C_k
 
         #u_k_1 = self.G(u_k_1)
-        u_k_1_list = [u_k_1] * self.story_size
-
-        queries_temp = torch.squeeze(torch.stack(u_k_1_list, dim=1), 2)
+        # the query is broadcast over the memories by the bmm, not replicated
         #probabs = mem_emb_A_temp * queries_temp
         # zero out the masked (padded) sentence embeddings:
         #probabs = probabs * PM.unsqueeze(2).expand_as(probabs)
-        probabs = self.cos(mem_emb_A_temp, queries_temp)
+        probabs = cosine_scores(mem_emb_A_temp, u_k_1)
         #probabs = masked_softmax(torch.squeeze(torch.sum(probabs, dim=2)), PM)
         probabs = masked_softmax(probabs, PM)
 
         if no_aggregate:  # use only best win
             max_win_ids = torch.argmax(probabs, dim=1)  # b*
-            o = mem_emb_C[range(probabs.size(0)), max_win_ids]
+            rows = torch.arange(probabs.size(0), device=probabs.device)
+            if mem_emb_C is None:
+                o = self.encoder(trainS[rows, max_win_ids], C_k, SM[rows, max_win_ids], positional)  # b*d
+            else:
+                o = mem_emb_C[rows, max_win_ids]
         else:  # att-weighted average of passage win vectors
-            mem_emb_C_temp = mem_emb_C_temp.permute(0, 2, 1)
-            probabs_temp = probabs.unsqueeze(1).expand_as(mem_emb_C_temp)
-
-            pre_w = torch.mul(mem_emb_C_temp, probabs_temp)
-
-            o = torch.sum(pre_w, dim=2)
+            o = weighted_sum(mem_emb_C_temp, probabs)
         #u_k = torch.squeeze(o) #+ torch.squeeze(u_k_1)
         #return u_k
         if last_hop:
             if use_att_feat:
-                att_feat = torch.zeros(probabs.size(0), self.output_size, device="cuda")
+                att_feat = torch.zeros(probabs.size(0), self.output_size, device=probabs.device)
+                # output id of the first entity in each window
+                win_ents = self.is_entity[trainS]  # b*n*win_size
+                has_ent = win_ents.any(dim=2)  # b*n
+                first_ent = trainS.gather(2, win_ents.int().argmax(dim=2, keepdim=True)).squeeze(2)  # b*n
+                win_out_ids = self.output_ids[first_ent]
                 if hard_att_feat:
                     # attention feature: one-hot argmax which will be passed to the output layer
                     max_win_ids = torch.argmax(probabs, dim=1)  # b*
-                    max_wins = trainS[range(probabs.size(0)), max_win_ids]  # b*win_size
-                    for b, win in enumerate(max_wins):
-                        idx = None
-                        for w in win:
-                            if self.inv_word_idx[w.item()].startswith("@entity"):
-                                idx = int(self.inv_word_idx[w.item()][len("@entity"):])
-                                break
-                        assert idx is not None
-                        att_feat[b, idx] = 1.
+                    rows = torch.arange(probabs.size(0), device=probabs.device)
+                    assert has_ent[rows, max_win_ids].all()
+                    att_feat[rows, win_out_ids[rows, max_win_ids]] = 1.
                 else:
-                    for b, wins in enumerate(trainS):
-                        for n, win in enumerate(wins):
-                            idx = None
-                            for w in win:
-                                if w.item() == 0:
-                                    continue
-                                if self.inv_word_idx[w.item()].startswith("@entity"):
-                                    idx = int(self.inv_word_idx[w.item()][len("@entity"):])
-                                    break
-                            att_feat[b, idx] += probabs[b,n].item()
+                    # attention mass per entity; windows without one add theirs to every output
+                    probabs_d = probabs.detach()
+                    att_feat.scatter_add_(1, win_out_ids * has_ent, probabs_d * has_ent)
+                    att_feat += (probabs_d * ~has_ent).sum(dim=1, keepdim=True)
 
                 if att_only_out:
                     out = att_feat
@@ -273,60 +309,27 @@ class N2N(torch.nn.Module):
             else:
                 return out
         else:
-            return torch.squeeze(self.G(o)) + torch.squeeze(u_k_1)
-
-    def embed_story(self, story_batch, embedding_layer, sent_mask, positional=True):
-        story_embedding_list = []
-        if positional:
-            position_encoding = get_position_encoding(story_batch.size()[1], story_batch.size()[2], self.embed_size)
-        else:
-            position_encoding = None
-
-        for story in story_batch.split(1):
-            story_variable = Variable(torch.squeeze(story, 0).data.type(long_tensor_type))
-            story_embedding = embedding_layer(story_variable)
-            if position_encoding is not None:
-                story_embedding = story_embedding * position_encoding
-            story_embedding_list.append(story_embedding)
-
-        batch_story_embedding_temp = torch.stack(story_embedding_list)
-        # zero out the masked (padded) word embeddings in the passage:
-        batch_story_embedding_temp = batch_story_embedding_temp * sent_mask.unsqueeze(3).expand_as(batch_story_embedding_temp)
-        batch_story_embedding = torch.sum(batch_story_embedding_temp, dim=2)
-        if self.args.average_embs:
-            normalizer = torch.sum(sent_mask, dim=2).unsqueeze(2).expand_as(batch_story_embedding)
-            normalizer[normalizer==0.] = float("Inf")
-            batch_story_embedding = batch_story_embedding / normalizer
-
-        return torch.squeeze(batch_story_embedding, dim=2)
+            u_k = torch.squeeze(self.G(o)) + torch.squeeze(u_k_1)
+            if inspect:
+                return u_k, probabs
+            else:
+                return u_k
 
 
 class KVN2N(N2N):
     def forward(self, trainK, trainV, trainQ, trainVM, trainPM, trainKM, trainQM, inspect, positional=True):
         """
-        :param trainVM: a B*V tensor masking all predictions which are not words/entities in the relevant document
+        :param trainVM: (offsets, ids) of the words/entities in the relevant document, per instance; all other predictions are masked
         """
         K = Variable(trainK, requires_grad=False)
         V = Variable(trainV, requires_grad=False)
         Q = Variable(torch.squeeze(trainQ, 1), requires_grad=False)
 
-        queries = self.A1(Q)
-        #queries_emb = self.B1(Q)
-
-        if positional:
-            position_encoding = get_position_encoding(queries.size(0), queries.size(1), self.embed_size)
-            queries = queries * position_encoding
-        # zero out the masked (padded) word embeddings:
-        queries = queries * trainQM.unsqueeze(2).expand_as(queries)
-
-        queries_rep = torch.sum(queries, dim=1)
+        queries_rep = self.encoder(Q, self.A1, trainQM, positional)
+        #queries_rep = self.encoder(Q, self.B1, trainQM, positional)
         # w_u = queries_sum
         # for i in range(self.hops):
         #     w_u = self.one_hop(S, w_u, self.A[i], self.A[i + 1], self.TA[i], self.TA[i + 1])
-        if self.args.average_embs:
-            normalizer = torch.sum(trainQM, dim=1).unsqueeze(1).expand_as(queries_rep)
-            normalizer[normalizer==0.] = float("Inf")
-            queries_rep = queries_rep / normalizer
 
         if inspect:
             #w_u, att_probs = self.hop(S, queries_rep, self.A1, self.A2, trainPM, trainSM, inspect)  # , self.TA, self.TA2)
@@ -373,7 +376,7 @@ class KVN2N(N2N):
         #    y_pred = y_pred * trainVM
         #return y_pred
 
-        y_pred_m = trainVM
+        y_pred_m = index_mask(trainVM, y_pred.size(1))
         #y_pred_m = None
         out = masked_log_softmax(y_pred, y_pred_m)
         if inspect:
@@ -382,27 +385,20 @@ class KVN2N(N2N):
             return out
 
     def hop(self, trainK, trainV, u_k_1, A_k, C_k, PM, KM, inspect, positional=True):  # , temp_A_k, temp_C_k):
-        mem_emb_A = self.embed_story(trainK, A_k, KM, positional=positional)  # B*S*d
+        mem_emb_A = self.encoder(trainK, A_k, KM, positional=positional)  # B*S*d
         mem_emb_C = self.embed_values(trainV, C_k)  # B*S*d
 
         mem_emb_A_temp = mem_emb_A  # + temp_A_k
         mem_emb_C_temp = mem_emb_C  # + temp_C_k
 
         #u_k_1 = self.G(u_k_1)
-        u_k_1_list = [u_k_1] * self.story_size
-
-        queries_temp = torch.squeeze(torch.stack(u_k_1_list, dim=1), 2)
+        # the query is broadcast over the memories by the bmm, not replicated
         #probabs = mem_emb_A_temp * queries_temp
         # zero out the masked (padded) sentence embeddings:
         #probabs = probabs * PM.unsqueeze(2).expand_as(probabs)
-        probabs = self.cos(mem_emb_A_temp, queries_temp)  # B*S
+        probabs = cosine_scores(mem_emb_A_temp, u_k_1)  # B*S
         probabs = masked_softmax(probabs, PM)  # B*S
-        mem_emb_C_temp = mem_emb_C_temp.permute(0, 2, 1)   # B*d*S
-        probabs_temp = probabs.unsqueeze(1).expand_as(mem_emb_C_temp)
-
-        pre_w = torch.mul(mem_emb_C_temp, probabs_temp)
-
-        o = torch.sum(pre_w, dim=2)
+        o = weighted_sum(mem_emb_C_temp, probabs)  # B*d
 
         #u_k = torch.squeeze(o) #+ torch.squeeze(u_k_1)
 
@@ -432,6 +428,7 @@ class KVAtt(torch.nn.Module):
         self.freeze_pretrained_word_embed = args.freeze_pretrained_word_embed
         self.word_idx = word_idx
         self.args = args
+        self.encoder = BowEncoder(embed_size, args.average_embs)
         self.output_size = output_size
 
         # story embedding
@@ -443,28 +440,14 @@ class KVAtt(torch.nn.Module):
             self.A1 = nn.Embedding(vocab_size, embed_size)
             self.A1.weight = nn.Parameter(torch.randn(vocab_size, embed_size).normal_(0, 0.1))
 
-        self.cos = nn.CosineSimilarity(dim=2)
-
     def forward(self, trainK, trainV, trainQ, trainVM, trainPM, trainKM, trainQM, inspect, positional=True, attention_sum=False):
         """
-        :param trainVM: a B*V tensor masking all predictions which are not words/entities in the relevant document
+        :param trainVM: (offsets, ids) of the words/entities in the relevant document, per instance; all other predictions are masked
         """
         K = Variable(trainK, requires_grad=False)
         Q = Variable(torch.squeeze(trainQ, 1), requires_grad=False)
 
-        queries = self.A1(Q)
-
-        if positional:
-            position_encoding = get_position_encoding(queries.size(0), queries.size(1), self.embed_size)
-            queries = queries * position_encoding
-        # zero out the masked (padded) word embeddings:
-        queries = queries * trainQM.unsqueeze(2).expand_as(queries)
-
-        queries_rep = torch.sum(queries, dim=1)
-        if self.args.average_embs:
-            normalizer = torch.sum(trainQM, dim=1).unsqueeze(1).expand_as(queries_rep)
-            normalizer[normalizer==0.] = float("Inf")
-            queries_rep = queries_rep / normalizer
+        queries_rep = self.encoder(Q, self.A1, trainQM, positional)
 
         att_scores = self.attention(K, queries_rep, self.A1, trainKM, positional=positional)  # , self.TA, self.TA2)
         # probs over keys
@@ -474,10 +457,10 @@ class KVAtt(torch.nn.Module):
         else:
             probs_out, idx_out = torch.max(att_probs, 1)
             # get ids for values
-            val_idx = trainV[range(self.batch_size), idx_out]
+            val_idx = trainV[range(trainV.size(0)), idx_out]
         # initialize y to very small number (log space)
-        y = Variable(torch.full((self.batch_size, self.output_size), -100.), requires_grad=False).type(float_tensor_type)
-        y[range(self.batch_size), val_idx] = probs_out
+        y = Variable(torch.full((trainV.size(0), self.output_size), -100.), requires_grad=False).type(float_tensor_type)
+        y[range(trainV.size(0)), val_idx] = probs_out
 
         return y, val_idx, att_probs
 
@@ -500,39 +483,12 @@ class KVAtt(torch.nn.Module):
 
 
     def attention(self, trainK, u_k_1, A_k, KM, positional=True):  # , temp_A_k, temp_C_k):
-        mem_emb_A = self.embed_story(trainK, A_k, KM, positional=positional)  # B*S*d
+        mem_emb_A = self.encoder(trainK, A_k, KM, positional=positional)  # B*S*d
         mem_emb_A_temp = mem_emb_A  # + temp_A_k
-        u_k_1_list = [u_k_1] * self.story_size
-        queries_temp = torch.squeeze(torch.stack(u_k_1_list, dim=1), 2)
-        att_scores = self.cos(mem_emb_A_temp, queries_temp)  # B*S
+        att_scores = cosine_scores(mem_emb_A_temp, u_k_1)  # B*S
 
         return att_scores
 
-    def embed_story(self, story_batch, embedding_layer, sent_mask, positional=True):
-        story_embedding_list = []
-        if positional:
-            position_encoding = get_position_encoding(story_batch.size()[1], story_batch.size()[2], self.embed_size)
-        else:
-            position_encoding = None
-
-        for story in story_batch.split(1):
-            story_variable = Variable(torch.squeeze(story, 0).data.type(long_tensor_type))
-            story_embedding = embedding_layer(story_variable)
-            if position_encoding is not None:
-                story_embedding = story_embedding * position_encoding
-            story_embedding_list.append(story_embedding)
-
-        batch_story_embedding_temp = torch.stack(story_embedding_list)
-        # zero out the masked (padded) word embeddings in the passage:
-        batch_story_embedding_temp = batch_story_embedding_temp * sent_mask.unsqueeze(3).expand_as(batch_story_embedding_temp)
-        batch_story_embedding = torch.sum(batch_story_embedding_temp, dim=2)
-        if self.args.average_embs:
-            normalizer = torch.sum(sent_mask, dim=2).unsqueeze(2).expand_as(batch_story_embedding)
-            normalizer[normalizer==0.] = float("Inf")
-            batch_story_embedding = batch_story_embedding / normalizer
-
-        return torch.squeeze(batch_story_embedding, dim=2)
-
 
 class QueryClassifier(torch.nn.Module):
     def __init__(self, batch_size, embed_size, vocab_size, args, word_idx, output_size):
@@ -544,6 +500,7 @@ class QueryClassifier(torch.nn.Module):
         self.freeze_pretrained_word_embed = args.freeze_pretrained_word_embed
         self.word_idx = word_idx
         self.args = args
+        self.encoder = BowEncoder(embed_size, args.average_embs)
 
         # story embedding
         if args.pretrained_word_embed:
@@ -557,27 +514,18 @@ class QueryClassifier(torch.nn.Module):
 
     def forward(self, trainS, trainQ, trainVM, trainPM, trainSM, trainQM, inspect):
         """
-        :param trainVM: a B*V tensor masking all predictions which are not words/entities in the relevant document
+        :param trainVM: (offsets, ids) of the words/entities in the relevant document, per instance; all other predictions are masked
         """
         Q = Variable(torch.squeeze(trainQ, 1), requires_grad=False)
-        queries_emb = self.A1(Q)
-        position_encoding = get_position_encoding(queries_emb.size(0), queries_emb.size(1), self.embed_size)
-        queries = queries_emb * position_encoding
-        # zero out the masked (padded) word embeddings:
-        queries = queries * trainQM.unsqueeze(2).expand_as(queries)
-        queries_rep = torch.sum(queries, dim=1)
+        queries_rep = self.encoder(Q, self.A1, trainQM)
         # w_u = queries_sum
         # for i in range(self.hops):
         #     w_u = self.one_hop(S, w_u, self.A[i], self.A[i + 1], self.TA[i], self.TA[i + 1])
-        if self.args.average_embs:
-            normalizer = torch.sum(trainQM, dim=1).unsqueeze(1).expand_as(queries_rep)
-            normalizer[normalizer==0.] = float("Inf")
-            queries_rep = queries_rep / normalizer
 
         y_pred = self.lin_final(queries_rep)
 
         # mask for output answers
-        y_pred_m = trainVM
+        y_pred_m = index_mask(trainVM, y_pred.size(1))
         #y_pred_m = None
 
         out = masked_log_softmax(y_pred, y_pred_m)
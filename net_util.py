@@ -84,3 +84,42 @@ def masked_log_softmax(vector: torch.Tensor, mask: torch.Tensor, dim: int = -1)
         vector = vector + (mask + 1e-45).log()
     return torch.nn.functional.log_softmax(vector, dim=dim)
 
+
+
+def index_mask(indices, size: int) -> torch.Tensor:
+    """
+    Builds a ``(batch_size, size)`` mask, with ones at the given column ids and zeros elsewhere, on
+    the device of the ids.  ``indices`` is an ``(offsets, ids)`` pair as in a CSR matrix: the ids of
+    row ``i`` are ``ids[offsets[i]:offsets[i + 1]]``.  Passing ``None`` returns ``None`` (no mask).
+    """
+    if indices is None:
+        return None
+    offsets, ids = indices
+    counts = offsets[1:] - offsets[:-1]
+    rows = torch.repeat_interleave(torch.arange(counts.size(0), device=ids.device), counts)
+    mask = torch.zeros(counts.size(0), size, device=ids.device)
+    mask[rows, ids] = 1.
+    return mask
+
+
+def weighted_sum(matrix: torch.Tensor, attention: torch.Tensor) -> torch.Tensor:
+    """
+    Takes a matrix of vectors and a set of weights over the rows in the matrix (which we call an
+    "attention" vector), and returns a weighted sum of the rows in the matrix.  This is the typical
+    computation performed after an attention mechanism.  Here ``matrix`` is ``(batch_size,
+    num_rows, embedding_dim)`` and ``attention`` is ``(batch_size, num_rows)``; the sum is a single
+    ``bmm``, giving ``(batch_size, embedding_dim)``.
+    """
+    return attention.unsqueeze(1).bmm(matrix).squeeze(1)
+
+
+def cosine_scores(matrix: torch.Tensor, vector: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
+    """
+    The cosine similarity of each row of ``matrix`` (``(batch_size, num_rows, embedding_dim)``) to the
+    ``vector`` of its batch (``(batch_size, embedding_dim)``), as ``torch.nn.CosineSimilarity(dim=2)``
+    with the vector repeated for every row, but from one ``bmm`` and the norms: nothing of the size
+    of ``matrix`` is allocated.  Returns ``(batch_size, num_rows)``.
+    """
+    dots = matrix.bmm(vector.unsqueeze(2)).squeeze(2)
+    norms = matrix.norm(dim=2).clamp(min=eps) * vector.norm(dim=1, keepdim=True).clamp(min=eps)
+    return dots / norms
@@ -1,17 +1,20 @@
 import functools
+import hashlib
 import json
 import os
+import pickle
 import re
+import shutil
 import subprocess
-from collections import Counter
-from functools import reduce
-from itertools import chain
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+import multiprocessing
 from tqdm import tqdm
 
 import numpy as np
 import torch
 from sklearn import model_selection
-from sklearn.metrics import jaccard_similarity_score
 from torch import nn
 from torch.autograd import Variable
 
@@ -22,9 +25,12 @@ The original code seems to be largely taken from https://github.com/siyuanzhao/k
 long_tensor_type = torch.LongTensor
 float_tensor_type = torch.FloatTensor
 
+tensor_device = torch.device("cpu")
+
 if (torch.cuda.is_available()):
     long_tensor_type = torch.cuda.LongTensor
     float_tensor_type = torch.cuda.FloatTensor
+    tensor_device = torch.device("cuda")
 
 DATA_KEY = "data"
 VERSION_KEY = "version"
@@ -45,9 +51,83 @@ PLACEHOLDER_KEY = "@placeholder"
 SYMB_BEGIN = "@begin"
 SYMB_END = "@end"
 
+# bump whenever the output of the loaders changes, so that stale cached datasets are not reused
+CACHE_VERSION = 4
+# likewise for the arrays of vectorized datasets kept on disk (see vectorize_set)
+SHARD_VERSION = 2
+
+
+def file_digest(fns, block_size=1 << 20):
+    """
+    Content hash over all source files.
+    """
+    h = hashlib.sha1()
+    for fn in fns:
+        with open(fn, "rb") as in_f:
+            for block in iter(lambda: in_f.read(block_size), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, name, source_files, params):
+    """
+    The cache key combines the content of the source files with all parameters affecting the loader output.
+    """
+    key = hashlib.sha1()
+    key.update(file_digest(source_files).encode())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    key.update(str(CACHE_VERSION).encode())
+    return os.path.join(cache_dir, "{}_{}.pkl".format(name, key.hexdigest()))
+
+
+def cached(cache_dir, name, source_files, params, build, log=None):
+    """
+    Return the output of build(), reading it from cache_dir if it has been stored before under the same key.
+    Caching is disabled when cache_dir is None.
+    """
+    if cache_dir is None:
+        return build()
+    path = cache_path(cache_dir, name, source_files, params)
+    if os.path.exists(path):
+        if log is not None:
+            log.info("Loading cached dataset from {}".format(path))
+        with open(path, "rb") as in_f:
+            return pickle.load(in_f)
+    result = build()
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first so that concurrent runs never see a partial pickle
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as out:
+        pickle.dump(result, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    if log is not None:
+        log.info("Cached dataset to {}".format(path))
+    return result
+
+
+def clicr_files(data_dir):
+    return [data_dir + "train1.0.json", data_dir + "dev1.0.json", data_dir + "test1.0.json"]
+
+
+def cbt_files(data_dir, dataset_part):
+    """
+    :param dataset_part: a CBT part, or several joined by commas, e.g. "NE,CN"
+    """
+    return [data_dir + "cbtest_{}_{}.txt".format(part, split) for part in dataset_part.split(",")
+            for split in ("train", "valid_2000ex", "test_2500ex")]
+
 
 def process_data_clicr(args, log):
-    data, val_data, test_data, vocab = load_data_clicr(args.data_dir, args.ent_setup, log, args.max_n_load)
+    params = {"ent_setup": args.ent_setup, "max_n_load": args.max_n_load, "memory_size": args.memory_size,
+              "max_vocab_size": args.max_vocab_size, "min_freq": args.min_freq}
+
+    return cached(args.cache_dir, "clicr", clicr_files(args.data_dir) + vocab_files(args), params,
+                  lambda: _process_data_clicr(args, log), log)
+
+
+def _process_data_clicr(args, log):
+    data, val_data, test_data, vocab = load_data_clicr(args.data_dir, args.ent_setup, log, args.max_n_load, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     clicr data is of the form:
@@ -73,9 +153,11 @@ def process_data_clicr(args, log):
         ()
     ]
     '''
-    memory_size, sentence_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values_clicr(data=data, debug=args.debug,
-                                                                                        memory_size=args.memory_size,
-                                                                                        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values(stats, debug=args.debug,
+                                                                                            memory_size=args.memory_size,
+                                                                                            vocab=vocab, log=log)
+    sentence_size = max(stats.query_size, stats.sentence_size)  # for the position
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
         log.info("Output Size: {}".format(output_size))
@@ -83,7 +165,16 @@ def process_data_clicr(args, log):
     return data, val_data, test_data, sentence_size, vocab_size, memory_size, word_idx, output_size, output_idx
 
 def process_data_clicr_win(args, log):
-    data, val_data, test_data, vocab = load_data_clicr_win(args.data_dir, args.ent_setup, log, args.max_n_load, args.win_size_kv, args.exclude_unseen_ans, args.max_vocab_size, args.anonymize)
+    params = {"ent_setup": args.ent_setup, "max_n_load": args.max_n_load, "win_size": args.win_size_kv,
+              "exclude_unseen_ans": args.exclude_unseen_ans, "max_vocab_size": args.max_vocab_size,
+              "anonymize": args.anonymize, "memory_size": args.memory_size, "min_freq": args.min_freq}
+
+    return cached(args.cache_dir, "clicr_win", clicr_files(args.data_dir) + vocab_files(args), params,
+                  lambda: _process_data_clicr_win(args, log), log)
+
+
+def _process_data_clicr_win(args, log):
+    data, val_data, test_data, vocab = load_data_clicr_win(args.data_dir, args.ent_setup, log, args.max_n_load, args.win_size_kv, args.exclude_unseen_ans, args.max_vocab_size, args.anonymize, args.n_workers, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     clicr data is of the form:
@@ -109,9 +200,11 @@ def process_data_clicr_win(args, log):
         ()
     ]
     '''
-    memory_size, sentence_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values_clicr_win(data=data, debug=args.debug,
-                                                                                        memory_size=args.memory_size,
-                                                                                        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values(stats, debug=args.debug,
+                                                                                            memory_size=args.memory_size,
+                                                                                            vocab=vocab, log=log)
+    sentence_size = max(stats.query_size, stats.sentence_size)  # for the position
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
 
@@ -119,7 +212,16 @@ def process_data_clicr_win(args, log):
 
 
 def process_data_cbt_win(args, log):
-    data, val_data, test_data, vocab = load_data_cbt_win(args.data_dir, args.ent_setup, log, args.max_n_load, args.win_size_kv, args.dataset_part, args.exclude_unseen_ans)
+    params = {"ent_setup": args.ent_setup, "max_n_load": args.max_n_load, "win_size": args.win_size_kv,
+              "dataset_part": args.dataset_part, "exclude_unseen_ans": args.exclude_unseen_ans,
+              "memory_size": args.memory_size, "max_vocab_size": args.max_vocab_size, "min_freq": args.min_freq}
+
+    return cached(args.cache_dir, "cbt_win", cbt_files(args.data_dir, args.dataset_part) + vocab_files(args), params,
+                  lambda: _process_data_cbt_win(args, log), log)
+
+
+def _process_data_cbt_win(args, log):
+    data, val_data, test_data, vocab = load_data_cbt_win(args.data_dir, args.ent_setup, log, args.max_n_load, args.win_size_kv, args.dataset_part, args.exclude_unseen_ans, args.n_workers, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     cbt win data is of the form:
@@ -145,9 +247,11 @@ def process_data_cbt_win(args, log):
         ()
     ]
     '''
-    memory_size, sentence_size, vocab_size, word_idx = calculate_parameter_values_cbt_win(data=data, debug=args.debug,
-                                                                                        memory_size=args.memory_size,
-                                                                                        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, _, _ = calculate_parameter_values(stats, debug=args.debug,
+                                                                         memory_size=args.memory_size,
+                                                                         vocab=vocab, log=log)
+    sentence_size = max(stats.query_size, stats.sentence_size)  # for the position
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
         #log.info("Output Size: {}".format(output_size))
@@ -156,7 +260,15 @@ def process_data_cbt_win(args, log):
 
 
 def process_data_clicr_kv(args, log):
-    data, val_data, test_data, vocab = load_data_clicr_kv(args.data_dir, args.ent_setup, log, args.win_size_kv, args.max_n_load)
+    params = {"ent_setup": args.ent_setup, "max_n_load": args.max_n_load, "win_size": args.win_size_kv,
+              "memory_size": args.memory_size, "max_vocab_size": args.max_vocab_size, "min_freq": args.min_freq}
+
+    return cached(args.cache_dir, "clicr_kv", clicr_files(args.data_dir) + vocab_files(args), params,
+                  lambda: _process_data_clicr_kv(args, log), log)
+
+
+def _process_data_clicr_kv(args, log):
+    data, val_data, test_data, vocab = load_data_clicr_kv(args.data_dir, args.ent_setup, log, args.win_size_kv, args.max_n_load, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     clicr data is of the form:
@@ -181,9 +293,12 @@ def process_data_clicr_kv(args, log):
         ()
     ]
     '''
-    memory_size, k_size, v_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values_clicr_kv(data=data, debug=args.debug,
-                                                                                        memory_size=args.memory_size,
-                                                                                        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values(stats, debug=args.debug,
+                                                                                            memory_size=args.memory_size,
+                                                                                            vocab=vocab, log=log)
+    k_size = stats.sentence_size
+    v_size = None
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
         log.info("Output Size: {}".format(output_size))
@@ -192,7 +307,7 @@ def process_data_clicr_kv(args, log):
 
 
 def process_data_cbt_kv(args, log):
-    data, val_data, test_data, vocab = load_data_clicr_kv(args.data_dir, args.ent_setup, log, args.win_size_kv, args.max_n_load)
+    data, val_data, test_data, vocab = load_data_clicr_kv(args.data_dir, args.ent_setup, log, args.win_size_kv, args.max_n_load, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     cbt data is of the form:
@@ -217,9 +332,12 @@ def process_data_cbt_kv(args, log):
         ()
     ]
     '''
-    memory_size, k_size, v_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values_clicr_kv(data=data, debug=args.debug,
-                                                                                        memory_size=args.memory_size,
-                                                                                        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, output_size, output_idx = calculate_parameter_values(stats, debug=args.debug,
+                                                                                            memory_size=args.memory_size,
+                                                                                            vocab=vocab, log=log)
+    k_size = stats.sentence_size
+    v_size = None
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
         log.info("Output Size: {}".format(output_size))
@@ -228,88 +346,240 @@ def process_data_cbt_kv(args, log):
 
 
 def process_data_kv(args, log):
-    data, test_data, vocab = load_data_kv(args.data_dir, args.joint_training, args.task_number, args.win_size_kv)
+    data, test_data, vocab = load_data_kv(args.data_dir, args.joint_training, args.task_number, args.win_size_kv, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     
     '''
-    memory_size, k_size, v_size, vocab_size, word_idx = calculate_parameter_values_kv(
-        data=data, debug=args.debug,
-        memory_size=args.memory_size,
-        vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, _, _ = calculate_parameter_values(stats, debug=args.debug,
+                                                                         memory_size=args.memory_size,
+                                                                         vocab=vocab, log=log)
+    k_size = stats.sentence_size
+    v_size = None
     if args.debug:
         log.info("Vocabulary Size: {}".format(vocab_size))
 
     return data, test_data, k_size, v_size, vocab_size, memory_size, word_idx
 
-def load_clicr_win(fn, ent_setup="ent", remove_notfound=True, max_n_load=None, win_size=3, anonymize=False):
+def load_clicr_win(fn, ent_setup="ent", remove_notfound=True, max_n_load=None, win_size=3, anonymize=False, n_workers=1):
+    docs = iter_json_data(fn)
+    if max_n_load is not None:
+        docs = islice(docs, max_n_load + 2)
+    process_doc = functools.partial(process_doc_clicr_win, remove_notfound=remove_notfound, win_size=win_size,
+                                    anonymize=anonymize)
+    store = DocStore()
     questions = []
-    raw = load_json(fn)
-    for c, datum in enumerate(raw[DATA_KEY]):
-        doc_txt = datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]
-        # keys include values
-        keys, values, (entity_dict, inv_entity_dict) = prepare_win(doc_txt, win_size=win_size, anonymize=anonymize)  # n_words*d
+    for doc_questions in map_docs(process_doc, docs, n_workers):
+        if not doc_questions:
+            continue
+        # the questions of a document share its windows, which are stored once
+        passage = store.add(doc_questions[0][0])
+        questions.extend((passage,) + q[1:] for q in doc_questions)
 
-        sents = []
-        for sent in doc_txt.split("\n"):
-            if sent:
-                sents.append(to_entities(sent))
-        document = " ".join(sents)
+    return questions
 
-        for qa in datum[DOC_KEY][QAS_KEY]:
-            doc_raw = entity_dict.keys() if anonymize else document.split()
-            query_id = qa[ID_KEY]
-            query = qa[QUERY_KEY]
-            query_win = prepare_q_for_kv(query, win_size=win_size)
-            ans_raw = ""
-            for ans in qa[ANS_KEY]:
-                if ans[ORIG_KEY] == "dataset":
-                    ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-            assert ans_raw
-            if remove_notfound:  # should be always false for dev and test
-                if ans_raw not in doc_raw:
-                    found_umls = False
-                    for ans in qa[ANS_KEY]:
-                        if ans[ORIG_KEY] == "UMLS":
-                            umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-                            if umls_answer in doc_raw:
-                                found_umls = True
-                                ans_raw = umls_answer
-                    if not found_umls:
-                        continue
-            if anonymize:
-                if ans_raw not in entity_dict:
-                    entity_dict[ans_raw] = "@entity" + str(len(entity_dict))
-                ans_raw = entity_dict[ans_raw]
-                cand_e = inv_entity_dict.keys()
-                cand_raw = [[e] for e in cand_e]
-            else:
-                cand_e = [w.lower() for w in doc_raw if w.startswith('@entity')]
-                cand_raw = [[e] for e in cand_e]
-            questions.append((keys, query_win, [ans_raw], cand_raw, None, (query_id, inv_entity_dict)))
-        if max_n_load is not None and c > max_n_load:
-            break
+
+class DocStore(object):
+    """
+    Passages (lists of windows) shared by the questions about them. Each passage is stored, and integer-encoded
+    for vectorization, only once.
+    """
+    def __init__(self):
+        self.passages = []
+        self._encoded = {}
+        self._encoded_with = None
+        self._output_ids = {}
+        self._output_ids_with = None
+
+    def __getstate__(self):
+        return {"passages": self.passages}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.passages = state["passages"]
+
+    def add(self, passage):
+        self.passages.append(passage)
+        return Passage(self, len(self.passages) - 1)
+
+    def encoded(self, doc_id, word_idx, win_size):
+        """
+        :return: the windows of the passage as lists of word ids, padded or cut to win_size
+        """
+        if self._encoded_with is None or self._encoded_with[0] is not word_idx or self._encoded_with[1] != win_size:
+            self._encoded = {}
+            self._encoded_with = (word_idx, win_size)
+        if doc_id not in self._encoded:
+            unk = word_idx["_UNK_"]
+            ws = []
+            for win in self.passages[doc_id]:
+                ls = max(0, win_size - len(win))
+                sent = [word_idx.get(w, unk) for w in win] + [0] * ls  # TODO pad zeros where truly missing, not only at end
+                if len(sent) > win_size:  # can happen in test/val as sentence_size is calculated on train
+                    sent = sent[:win_size]
+                ws.append(sent)
+            self._encoded[doc_id] = ws
+        return self._encoded[doc_id]
+
+    def output_ids(self, doc_id, word_idx, output_idx, win_size):
+        """
+        :return: the output ids of the words in the encoded passage, i.e. what the vocabulary mask marks
+        """
+        w = self._output_ids_with
+        if w is None or w[0] is not word_idx or w[1] is not output_idx or w[2] != win_size:
+            self._output_ids = {}
+            self._output_ids_with = (word_idx, output_idx, win_size)
+        if doc_id not in self._output_ids:
+            self._output_ids[doc_id] = window_output_ids(self.encoded(doc_id, word_idx, win_size),
+                                                         word_lookup(word_idx, output_idx).output_ids)
+        return self._output_ids[doc_id]
+
+
+class Passage(object):
+    """
+    Reference to a passage in a DocStore. Behaves as the list of windows it stands for.
+    """
+    __slots__ = ("store", "doc_id")
+
+    def __init__(self, store, doc_id):
+        self.store = store
+        self.doc_id = doc_id
+
+    def __len__(self):
+        return len(self.store.passages[self.doc_id])
+
+    def __iter__(self):
+        return iter(self.store.passages[self.doc_id])
+
+    def __getitem__(self, i):
+        return self.store.passages[self.doc_id][i]
+
+    def encoded(self, word_idx, win_size):
+        return self.store.encoded(self.doc_id, word_idx, win_size)
+
+    def word_counts(self):
+        return Counter(w for win in self for w in win)
+
+    def output_ids(self, word_idx, output_idx, win_size):
+        return self.store.output_ids(self.doc_id, word_idx, output_idx, win_size)
+
+
+class EntityIndex(object):
+    """
+    The tokens of a document, with the counts and first positions of its entities. Built once per document and
+    shared by its questions to look up answers and list the candidates.
+    """
+    __slots__ = ("tokens", "counts", "first")
+
+    def __init__(self, tokens):
+        self.tokens = set(tokens)
+        self.counts = Counter()
+        self.first = {}
+        for i, w in enumerate(tokens):
+            if w.startswith("@entity"):
+                self.counts[w] += 1
+                self.first.setdefault(w, i)
+
+    def __contains__(self, w):
+        return w in self.tokens
+
+    def __len__(self):
+        return len(self.first)
+
+    def candidates(self):
+        """
+        :return: the distinct entities in order of first occurrence
+        """
+        return list(self.first)
+
+
+def process_doc_clicr_win(datum, remove_notfound=True, win_size=3, anonymize=False):
+    """
+    :return: the questions of one CliCR document
+    """
+    questions = []
+    doc_txt = datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]
+    # keys include values
+    lines = scan_text(doc_txt)  # read once for both the windows and the document
+    keys, values, (entity_dict, inv_entity_dict) = prepare_win(lines, win_size=win_size, anonymize=anonymize)  # n_words*d
+    # looked up by the answers of all questions
+    if anonymize:
+        doc_raw = entity_dict.keys()
+    else:
+        doc_raw = EntityIndex(" ".join(scan.entity_text() for scan in lines if scan.line).split())
+
+    for qa in datum[DOC_KEY][QAS_KEY]:
+        query_id = qa[ID_KEY]
+        query = qa[QUERY_KEY]
+        query_win = prepare_q_for_kv(query, win_size=win_size)
+        ans_raw = ""
+        for ans in qa[ANS_KEY]:
+            if ans[ORIG_KEY] == "dataset":
+                ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
+        assert ans_raw
+        if remove_notfound:  # should be always false for dev and test
+            if ans_raw not in doc_raw:
+                found_umls = False
+                for ans in qa[ANS_KEY]:
+                    if ans[ORIG_KEY] == "UMLS":
+                        umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
+                        if umls_answer in doc_raw:
+                            found_umls = True
+                            ans_raw = umls_answer
+                if not found_umls:
+                    continue
+        if anonymize:
+            if ans_raw not in entity_dict:
+                entity_dict[ans_raw] = "@entity" + str(len(entity_dict))
+            ans_raw = entity_dict[ans_raw]
+        # no candidate list: the candidates are the entities in the passage (see vectorize_data_clicr_win)
+        questions.append((keys, query_win, [ans_raw], None, None, (query_id, inv_entity_dict)))
 
     return questions
 
 
+def map_docs(fn, docs, n_workers=1, chunksize=16):
+    """
+    Apply fn to every document. With n_workers > 1, chunks of documents are fanned out to a process pool.
+    At most 2*n_workers chunks are in flight, and results are yielded in input order, so the output is
+    identical to the serial path.
+    """
+    if n_workers is None or n_workers <= 1:
+        for doc in docs:
+            yield fn(doc)
+        return
+    process_chunk = functools.partial(map_chunk, fn)
+    with multiprocessing.Pool(n_workers) as pool:
+        pending = deque()
+        docs = iter(docs)
+        while True:
+            chunk = list(islice(docs, chunksize))
+            if chunk:
+                pending.append(pool.apply_async(process_chunk, (chunk,)))
+            if pending and (not chunk or len(pending) >= 2 * n_workers):
+                for result in pending.popleft().get():
+                    yield result
+            elif not chunk:
+                break
+
+
+def map_chunk(fn, chunk):
+    return [fn(doc) for doc in chunk]
+
 
 def load_clicr_kv(fn, ent_setup="ent", win_size=3, remove_notfound=True, max_n_load=None):
     questions = []
-    raw = load_json(fn)
-    for c, datum in enumerate(raw[DATA_KEY]):
+    for c, datum in enumerate(iter_json_data(fn)):
         doc_txt = datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]
-        keys, values = prepare_kv(doc_txt, win_size=win_size)  # n_words*d
+        lines = scan_text(doc_txt)  # read once for both the windows and the document
+        keys, values = prepare_kv(lines, win_size=win_size)  # n_words*d
         assert len(keys) == len(values)
 
-        sents = []
-        for sent in doc_txt.split("\n"):
-            if sent:
-                sents.append(to_entities(sent))
-        document = " ".join(sents)
+        doc_index = EntityIndex(" ".join(scan.entity_text() for scan in lines if scan.line).split())
+        cand_raw = [[e] for e in dict.fromkeys(w.lower() for w in doc_index.candidates())]
 
         for qa in datum[DOC_KEY][QAS_KEY]:
-            doc_raw = document.split()
             query_id = qa[ID_KEY]
             query = qa[QUERY_KEY]
             query_win = prepare_q_for_kv(query, win_size=win_size)
@@ -319,18 +589,16 @@ def load_clicr_kv(fn, ent_setup="ent", win_size=3, remove_notfound=True, max_n_l
                     ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
             assert ans_raw
             if remove_notfound:  # should be always false for dev and test
-                if ans_raw not in doc_raw:
+                if ans_raw not in doc_index:
                     found_umls = False
                     for ans in qa[ANS_KEY]:
                         if ans[ORIG_KEY] == "UMLS":
                             umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-                            if umls_answer in doc_raw:
+                            if umls_answer in doc_index:
                                 found_umls = True
                                 ans_raw = umls_answer
                     if not found_umls:
                         continue
-            cand_e = [w.lower() for w in doc_raw if w.startswith('@entity')]
-            cand_raw = [[e] for e in cand_e]
             questions.append(((keys, values), query_win, [ans_raw], cand_raw, None, query_id))
         if max_n_load is not None and c > max_n_load:
             break
@@ -340,20 +608,16 @@ def load_clicr_kv(fn, ent_setup="ent", win_size=3, remove_notfound=True, max_n_l
 
 def load_clicr_kv_ent_only(fn, ent_setup="ent", win_size=3, remove_notfound=True, max_n_load=None):
     questions = []
-    raw = load_json(fn)
-    for c, datum in enumerate(raw[DATA_KEY]):
+    for c, datum in enumerate(iter_json_data(fn)):
         doc_txt = datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]
-        keys, values = prepare_kv_ent_only(doc_txt, win_size=win_size)  # n_words*d
+        lines = scan_text(doc_txt)  # read once for both the windows and the document
+        keys, values = prepare_kv_ent_only(lines, win_size=win_size)  # n_words*d
         assert len(keys) == len(values)
 
-        sents = []
-        for sent in doc_txt.split("\n"):
-            if sent:
-                sents.append(to_entities(sent))
-        document = " ".join(sents)
+        doc_index = EntityIndex(" ".join(scan.entity_text() for scan in lines if scan.line).split())
+        cand_raw = [[e] for e in dict.fromkeys(w.lower() for w in doc_index.candidates())]
 
         for qa in datum[DOC_KEY][QAS_KEY]:
-            doc_raw = document.split()
             query_id = qa[ID_KEY]
             query = qa[QUERY_KEY]
             query_win = prepare_q_for_kv(query, win_size=win_size)
@@ -363,18 +627,16 @@ def load_clicr_kv_ent_only(fn, ent_setup="ent", win_size=3, remove_notfound=True
                     ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
             assert ans_raw
             if remove_notfound:  # should be always false for dev and test
-                if ans_raw not in doc_raw:
+                if ans_raw not in doc_index:
                     found_umls = False
                     for ans in qa[ANS_KEY]:
                         if ans[ORIG_KEY] == "UMLS":
                             umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-                            if umls_answer in doc_raw:
+                            if umls_answer in doc_index:
                                 found_umls = True
                                 ans_raw = umls_answer
                     if not found_umls:
                         continue
-            cand_e = [w.lower() for w in doc_raw if w.startswith('@entity')]
-            cand_raw = [[e] for e in cand_e]
             questions.append(((keys, values), query_win, [ans_raw], cand_raw, None, query_id))
         if max_n_load is not None and c > max_n_load:
             break
@@ -437,30 +699,12 @@ def prepare_kv_babi(text, win_size=3):
 def prepare_kv(text, win_size=3):
     values = []
     keys = []  # n_words*(2*win_size)
-    for line in text.split("\n"):
-        idxs_start = [match.start() for match in re.finditer("BEG__", line)]
-        idxs_end = [match.end() for match in re.finditer("__END", line)]
-        for i_start, i_end in zip(idxs_start, idxs_end):
-            concept = line[i_start + len("BEG__"):i_end - len("__END")]
-            concept = "@entity" + concept.replace(" ", "_").lower()
-            txt_left = line[:i_start].strip()
-            lst_left = txt_left.split()
-            txt_right = line[i_end:].strip()
-            lst_right = txt_right.split()
-            lst = lst_left + lst_right
-            i = len(lst_left)
-            window_start = max(0, i - win_size)
-            window_end = min(len(lst), i + win_size)
-            contexts = []
-            # go over contexts
-            for j in range(window_start, window_end):
-                w = lst[j]
-                w = remove_concept_marks(w)
-                contexts.append(w.lower())
-            if not contexts:
-                continue
-            values.append(concept)
-            keys.append(contexts)
+    for concept, left, right in scanned_windows(text, win_size):
+        contexts = left + right
+        if not contexts:
+            continue
+        values.append(concept)
+        keys.append(contexts)
 
     assert len(values) > 0
 
@@ -468,53 +712,24 @@ def prepare_kv(text, win_size=3):
 
 
 def prepare_win(text, win_size=3, anonymize=False):
+    """
+    :param text: a string or its lines as returned by scan_text
+    """
     values = []
     keys = []  # n_words*(2*win_size)
     if anonymize:
         entity_dict = {}
         entity_id = 0
 
-    for line in text.split("\n"):
-        idxs_start = [match.start() for match in re.finditer("BEG__", line)]
-        idxs_end = [match.end() for match in re.finditer("__END", line)]
-        for i_start, i_end in zip(idxs_start, idxs_end):
-            concept = line[i_start + len("BEG__"):i_end - len("__END")]
-            concept = "@entity" + concept.replace(" ", "_").lower()
-
-            if anonymize:
-                if concept not in entity_dict:
-                    entity_dict[concept] = '@entity' + str(entity_id)
-                    entity_id += 1
-                concept = entity_dict[concept]
-
-            txt_left = line[:i_start].strip()
-            lst_left = txt_left.split()
-            txt_right = line[i_end:].strip()
-            lst_right = txt_right.split()
-            lst = lst_left + lst_right
-            i = len(lst_left)
-            window_start = max(0, i - win_size)
-            window_end = min(len(lst), i + win_size)
-            contexts = []
-            # go over contexts
-            #for j in range(window_start, window_end):
-            #    w = lst[j]
-            #    w = remove_concept_marks(w)
-            #    contexts.append(w.lower())
-            #contexts.append(concept)
-            for j in range(window_start, i):
-                w = lst[j]
-                w = remove_concept_marks(w)
-                contexts.append(w.lower())
-            contexts.append(concept)
-            for j in range(i, window_end):
-                w = lst[j]
-                w = remove_concept_marks(w)
-                contexts.append(w.lower())
-            if not contexts:
-                continue
-            values.append(concept)
-            keys.append(contexts)
+    for concept, left, right in scanned_windows(text, win_size):
+        if anonymize:
+            if concept not in entity_dict:
+                entity_dict[concept] = '@entity' + str(entity_id)
+                entity_id += 1
+            concept = entity_dict[concept]
+        contexts = left + [concept] + right
+        values.append(concept)
+        keys.append(contexts)
 
     if anonymize:
         inv_entity_dict = {ent_id: ent_ans for ent_ans, ent_id in entity_dict.items()}
@@ -527,42 +742,109 @@ def prepare_win(text, win_size=3, anonymize=False):
 def prepare_kv_ent_only(text, win_size=3):
     values = []
     keys = []  # n_words*(2*win_size)
-    for line in text.split("\n"):
-        idxs_start = [match.start() for match in re.finditer("BEG__", line)]
-        idxs_end = [match.end() for match in re.finditer("__END", line)]
-        for i_start, i_end in zip(idxs_start, idxs_end):
-            concept = line[i_start + len("BEG__"):i_end - len("__END")]
-            concept = "@entity" + concept.replace(" ", "_").lower()
-            txt_left = line[:i_start].strip()
-            lst_left = txt_left.split()
-            txt_right = line[i_end:].strip()
-            lst_right = txt_right.split()
-            lst = lst_left + lst_right
-            i = len(lst_left)
-            window_start = max(0, i - win_size)
-            window_end = min(len(lst), i + win_size)
-            contexts = []
-            # go over contexts
-            for j in range(window_start, window_end):
-                w = lst[j]
-                w = remove_concept_marks(w)
-                contexts.append(w.lower())
-            if not contexts:
-                continue
-            values.append(concept)
-            keys.append(contexts)
+    for concept, left, right in scanned_windows(text, win_size):
+        contexts = left + right
+        if not contexts:
+            continue
+        values.append(concept)
+        keys.append(contexts)
 
     assert len(values) > 0
 
     return keys, values
 
 
+_TOKENIZE_RE = re.compile(r'(\W+)?')
+
+
+class ScannedLine(object):
+    """
+    A line of text scanned once for entity markers. Holds the entity spans delimited by BEG__ and __END, from
+    which the context windows of prepare_kv and prepare_win and the entity-joined text are read.
+    """
+    __slots__ = ("line", "spans", "balanced")
+
+    def __init__(self, line):
+        self.line = line
+        if "__" not in line:
+            self.spans = []
+            self.balanced = True
+            return
+        starts = []
+        i = line.find("BEG__")
+        while i >= 0:
+            starts.append(i)
+            i = line.find("BEG__", i + 1)
+        ends = []
+        i = line.find("__END")
+        while i >= 0:
+            ends.append(i + len("__END"))
+            i = line.find("__END", i + 1)
+        self.spans = list(zip(starts, ends))
+        self.balanced = len(starts) == len(ends)
+
+    def windows(self, win_size):
+        """
+        Yield (concept, left context, right context) for every entity span, with at most win_size lowercased
+        context words on each side. Only the words inside the window are split off the line.
+        """
+        line = self.line
+        for i_start, i_end in self.spans:
+            concept = line[i_start + len("BEG__"):i_end - len("__END")]
+            concept = "@entity" + concept.replace(" ", "_").lower()
+            if win_size > 0:
+                # remove_concept_marks, inlined
+                left = [w.replace("BEG__", "").replace("__END", "").lower()
+                        for w in line[:i_start].rsplit(None, win_size)[-win_size:]]
+                right = [w.replace("BEG__", "").replace("__END", "").lower()
+                         for w in line[i_end:].split(None, win_size)[:win_size]]
+            else:
+                left = []
+                right = []
+            yield concept, left, right
+
+    def entity_text(self):
+        """
+        The line with every entity joined to a single token @entityw1_w2_w3, read from the spans. Markup that does
+        not delimit whole words, e.g. nested or unclosed entities, is left to the word-by-word parsing of to_entities.
+        """
+        line = self.line
+        if not self.balanced:
+            return to_entities(line)
+        pieces = []
+        i = 0
+        for i_start, i_end in self.spans:
+            concept = line[i_start + len("BEG__"):i_end - len("__END")]
+            if (i_start < i or (i_start > 0 and not line[i_start - 1].isspace()) or
+                    (i_end < len(line) and not line[i_end].isspace()) or
+                    not concept or concept[0].isspace() or concept[-1].isspace() or "_" in concept):
+                return to_entities(line)
+            pieces.append(line[i:i_start])
+            pieces.append("@entity" + "_".join(concept.split()))
+            i = i_end
+        pieces.append(line[i:])
+        return " ".join("".join(pieces).split())
+
+
+def scan_text(text):
+    return [ScannedLine(line) for line in text.split("\n")]
+
+
+def scanned_windows(text, win_size):
+    """
+    :param text: a string or its lines as returned by scan_text
+    """
+    for scan in (text if isinstance(text, list) else scan_text(text)):
+        for window in scan.windows(win_size):
+            yield window
+
+
 def remove_concept_marks(txt, marker1="BEG__", marker2="__END"):
     return txt.replace(marker1, "").replace(marker2, "")
 
 
 def process_data(args, log):
-    data, val_data, test_data, vocab = load_data(args.data_dir, args.joint_training, args.task_number)
+    data, val_data, test_data, vocab = load_data(args.data_dir, args.joint_training, args.task_number, args.max_vocab_size, args.min_freq, load_vocab(args.load_vocab) if args.load_vocab else None)
 
     '''
     data is of the form:
@@ -582,26 +864,86 @@ def process_data(args, log):
     ]
     '''
 
-    memory_size, sentence_size, vocab_size, word_idx = calculate_parameter_values(data=data, debug=args.debug,
-                                                                                  memory_size=args.memory_size,
-                                                                                  vocab=vocab, log=log)
+    stats = collect_stats(data)
+    memory_size, vocab_size, word_idx, _, _ = calculate_parameter_values(stats, debug=args.debug,
+                                                                         memory_size=args.memory_size,
+                                                                         vocab=vocab, log=log)
+    sentence_size = max(stats.query_size, stats.sentence_size)  # for the position
 
     return data, val_data, test_data, sentence_size, vocab_size, memory_size, word_idx
 
 
-def load_data_clicr(data_dir, ent_setup, log, max_n_load=None):
+def count_vocab(*datasets):
+    """
+    Count the words of (story, query, answer, ...) instances in one streaming pass, without building a word
+    list per instance. A story is a list of sentences or windows, a Passage, or a (keys, values) pair. The words
+    of a Passage are counted once and weighted by the number of instances that share it.
+    """
+    n_refs = Counter(id(inst[0]) for inst in chain(*datasets) if isinstance(inst[0], Passage))
+    counts = Counter()
+    for inst in chain(*datasets):
+        story, q, a = inst[0], inst[1], inst[2]
+        if isinstance(story, Passage):
+            if n_refs[id(story)]:
+                for w, f in story.word_counts().items():
+                    counts[w] += f * n_refs[id(story)]
+                n_refs[id(story)] = 0
+        elif isinstance(story, tuple):
+            keys, values = story
+            counts.update(chain.from_iterable(keys))
+            counts.update(values)
+        else:
+            counts.update(chain.from_iterable(story))
+        counts.update(q)
+        counts.update(a)
+
+    return counts
+
+
+def build_vocab(datasets, max_vocab_size=None, min_freq=1):
+    """
+    :param datasets: lists of instances, see count_vocab
+    :param max_vocab_size: keep only this many most frequent words
+    :param min_freq: keep only words occurring at least this many times
+    :return: the sorted vocabulary. Answers are always kept. _UNK_ is always added, the vectorizers map the words
+    cut here and the words of unseen data to it.
+    """
+    counts = count_vocab(*datasets)
+    vocab = {w for w, f in counts.most_common(max_vocab_size) if f >= min_freq}
+    vocab.update(w for inst in chain(*datasets) for w in inst[2])
+    vocab.add("_UNK_")
+
+    return sorted(vocab)
+
+
+def save_vocab(fn, word_idx, output_idx=None):
+    save_json({"word_idx": word_idx, "output_idx": output_idx}, fn)
+
+
+def load_vocab(fn):
+    """
+    :return: the vocabulary saved with save_vocab, in word id order. calculate_parameter_values derives the
+    same word_idx and output_idx from it. _UNK_ is appended if missing, keeping the ids of the other words.
+    """
+    word_idx = load_json(fn)["word_idx"]
+    vocab = sorted(word_idx, key=word_idx.get)
+    if "_UNK_" not in word_idx:
+        vocab.append("_UNK_")
+    return vocab
+
+
+def vocab_files(args):
+    return [args.load_vocab] if args.load_vocab else []
+
+
+def load_data_clicr(data_dir, ent_setup, log, max_n_load=None, max_vocab_size=None, min_freq=1, vocab=None):
     #train_data, _ = load_clicr_ent_only(data_dir + "train1.0.json", ent_setup, max_n_load=max_n_load)
     train_data, _ = load_clicr(data_dir + "train1.0.json", ent_setup, max_n_load=max_n_load)
     val_data, _ = load_clicr(data_dir + "dev1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load)
     test_data, _ = load_clicr(data_dir + "test1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load)
 
-    data = train_data + val_data + test_data  # TODO exclude test?
-
-    vocab_set = set()
-    for s, q, a, _, _, _ in data:
-        vocab_set.update([w for sent in s for w in sent] + q + a)
-
-    vocab = sorted(vocab_set)
+    if vocab is None:
+        vocab = build_vocab([train_data, val_data, test_data], max_vocab_size, min_freq)  # TODO exclude test?
 
     return train_data, val_data, test_data, vocab
 
@@ -633,7 +975,7 @@ def prune_test(train_data, test_data):
 
     return new_test_data
 
-def load_data_clicr_win(data_dir, ent_setup, log, max_n_load=None, win_size=3, exclude_unseen_ans=False, max_vocab_size=1e50, anonymize=False):
+def load_data_clicr_win(data_dir, ent_setup, log, max_n_load=None, win_size=3, exclude_unseen_ans=False, max_vocab_size=None, anonymize=False, n_workers=1, min_freq=1, vocab=None):
     #train_data, _ = load_clicr_ent_only(data_dir + "train1.0.json", ent_setup, max_n_load=max_n_load)
 
     #train_data_ne, _ = load_cbt_win(data_dir + "cbtest_NE_train.txt", ent_setup, max_n_load=max_n_load, win_size=win_size)
@@ -646,77 +988,158 @@ def load_data_clicr_win(data_dir, ent_setup, log, max_n_load=None, win_size=3, e
     #train_data = train_data_ne + train_data_cn + train_data_p + train_data_v
     #np.random.seed(1234)
     #np.random.shuffle(train_data)
-    train_data = load_clicr_win(data_dir + "train1.0.json", ent_setup, remove_notfound=True, max_n_load=max_n_load, win_size=win_size, anonymize=anonymize)
+    train_data = load_clicr_win(data_dir + "train1.0.json", ent_setup, remove_notfound=True, max_n_load=max_n_load, win_size=win_size, anonymize=anonymize, n_workers=n_workers)
     #val_data = load_clicr_win(data_dir + "dev1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load, win_size=win_size)
     #test_data = load_clicr_win(data_dir + "test1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load, win_size=win_size)
     val_data = load_clicr_win(data_dir + "dev1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load,
-                              win_size=win_size, anonymize=anonymize)
-    test_data = load_clicr_win(data_dir + "test1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load, win_size=win_size, anonymize=anonymize)
+                              win_size=win_size, anonymize=anonymize, n_workers=n_workers)
+    test_data = load_clicr_win(data_dir + "test1.0.json", ent_setup, remove_notfound=False, max_n_load=max_n_load, win_size=win_size, anonymize=anonymize, n_workers=n_workers)
 
     if exclude_unseen_ans:
         test_data = prune_test(train_data, test_data)
 
     cbt_stats(train_data, test_data)
-    data = train_data + val_data + test_data  # TODO exclude test?
-
-    #vocab_set = set()
-    #for s, q, a, _, _, _ in data:
-    #    vocab_set.update([w for sent in s for w in sent] + q + a)
-    vocab_cnt = Counter()
-    for s, q, a, _, _, _ in data:
-        vocab_cnt.update([w for sent in s for w in sent] + q + a)
-    
-    #vocab = sorted(vocab_set)
-    vocab = sorted([w for w,f in vocab_cnt.most_common(max_vocab_size)] + ["_UNK_"])
+
+    if vocab is None:
+        vocab = build_vocab([train_data, val_data, test_data], max_vocab_size, min_freq)  # TODO exclude test?
     print("size output layer:")
     print(len({w for w in vocab if w.startswith("@entity")}))
     return train_data, val_data, test_data, vocab
 
-def load_data_cbt_win(data_dir, ent_setup, log, max_n_load=None, win_size=3, dataset_part="NE", exclude_unseen_ans=False):
-    #train_data, _ = load_clicr_ent_only(data_dir + "train1.0.json", ent_setup, max_n_load=max_n_load)
-
-    #train_data_ne, _ = load_cbt_win(data_dir + "cbtest_NE_train.txt", ent_setup, max_n_load=max_n_load, win_size=win_size)
-    #train_data_cn, _ = load_cbt_win(data_dir + "cbtest_CN_train.txt", ent_setup, max_n_load=max_n_load,
-    #                                win_size=win_size)
-    #train_data_p, _ = load_cbt_win(data_dir + "cbtest_P_train.txt", ent_setup, max_n_load=max_n_load,
-    #                                win_size=win_size)
-    #train_data_v, _ = load_cbt_win(data_dir + "cbtest_V_train.txt", ent_setup, max_n_load=max_n_load,
-    #                               win_size=win_size)
-    #train_data = train_data_ne + train_data_cn + train_data_p + train_data_v
-    #np.random.seed(1234)
-    #np.random.shuffle(train_data)
-    train_data, _ = load_cbt_win(data_dir + "cbtest_{}_train.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size)
-    val_data, _ = load_cbt_win(data_dir + "cbtest_{}_valid_2000ex.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size)
-    test_data, _ = load_cbt_win(data_dir + "cbtest_{}_test_2500ex.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size)
+def load_data_cbt_win(data_dir, ent_setup, log, max_n_load=None, win_size=3, dataset_part="NE", exclude_unseen_ans=False, n_workers=1, max_vocab_size=None, min_freq=1, vocab=None):
+    """
+    :param dataset_part: a CBT part, or several joined by commas (e.g. "NE,CN,V,P") for joint training. The
+    training instances of several parts are interleaved in a random order, and their validation and test
+    instances are concatenated.
+    """
+    parts = dataset_part.split(",")
+    if len(parts) == 1:
+        train_data, _ = load_cbt_win(data_dir + "cbtest_{}_train.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size, n_workers=n_workers)
+        val_data, _ = load_cbt_win(data_dir + "cbtest_{}_valid_2000ex.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size, n_workers=n_workers)
+        test_data, _ = load_cbt_win(data_dir + "cbtest_{}_test_2500ex.txt".format(dataset_part), ent_setup, max_n_load=max_n_load, win_size=win_size, n_workers=n_workers)
+    else:
+        # with n_workers > 1, every part is read in its own process
+        train_data = load_cbt_win_parts([data_dir + "cbtest_{}_train.txt".format(part) for part in parts], max_n_load=max_n_load, win_size=win_size, concurrent=n_workers > 1, seed=1234)
+        val_data = load_cbt_win_parts([data_dir + "cbtest_{}_valid_2000ex.txt".format(part) for part in parts], max_n_load=max_n_load, win_size=win_size, concurrent=n_workers > 1)
+        test_data = load_cbt_win_parts([data_dir + "cbtest_{}_test_2500ex.txt".format(part) for part in parts], max_n_load=max_n_load, win_size=win_size, concurrent=n_workers > 1)
 
     if exclude_unseen_ans:
         test_data = prune_test(train_data, test_data)
 
     cbt_stats(train_data, test_data)
-    data = train_data + val_data + test_data  # TODO exclude test?
-
-    vocab_set = set()
-    for s, q, a, _, _, _ in data:
-        vocab_set.update([w for sent in s for w in sent] + q + a)
 
-    vocab = sorted(vocab_set)
+    if vocab is None:
+        # vocabulary of all parts
+        vocab = build_vocab([train_data, val_data, test_data], max_vocab_size, min_freq)  # TODO exclude test?
 
     return train_data, val_data, test_data, vocab
 
 
-def load_data_clicr_kv(data_dir, ent_setup, log, win_size=3, max_n_load=None):
+def load_cbt_win_parts(fns, max_n_load=None, win_size=3, include_cand=True, concurrent=False, seed=None,
+                       buffer_size=10000):
+    """
+    Load several CBT files into one list without loading them one after the other into separate lists first.
+    The files are read lazily, or concurrently in one process each, and their instances are interleaved.
+    The stream is collected into the one list the data is kept in, as vectorizing and training need it whole.
+
+    :param seed: if None, the files are concatenated in order. Otherwise, the next instance is drawn from a random
+    file, with probability proportional to the file size, so that the parts are mixed throughout the list, and the
+    stream is shuffled within a buffer of buffer_size instances (see shuffled), so that the instances of a part do
+    not stay in file order.
+    """
+    if concurrent:
+        streams = [iter_in_process(iter_cbt_win, (fn, max_n_load, win_size, include_cand)) for fn in fns]
+    else:
+        streams = [iter_cbt_win(fn, max_n_load, win_size, include_cand) for fn in fns]
+    if seed is None:
+        return list(chain.from_iterable(streams))
+    rng = np.random.RandomState(seed)
+    return list(shuffled(interleave(streams, [os.path.getsize(fn) for fn in fns], rng), rng, buffer_size))
+
+
+def iter_cbt_win(fn, max_n_load=None, win_size=3, include_cand=True):
+    insts = read_cbt(fn, max_n_load=max_n_load + 2 if max_n_load is not None else None)
+    for c_inst in enumerate(insts):
+        yield process_inst_cbt_win(c_inst, win_size=win_size, include_cand=include_cand)
+
+
+def interleave(iterators, weights, rng):
+    """
+    Yield the items of all iterators, each time taking the next item of an iterator drawn at random with the
+    given weights. Exhausted iterators are dropped.
+    """
+    iterators = list(iterators)
+    weights = np.array(weights, dtype=float)
+    while iterators:
+        i = rng.choice(len(iterators), p=weights / weights.sum())
+        try:
+            yield next(iterators[i])
+        except StopIteration:
+            del iterators[i]
+            weights = np.delete(weights, i)
+
+
+def shuffled(items, rng, buffer_size):
+    """
+    Yield the items in a random order, keeping at most buffer_size of them: each next item is drawn at random from
+    the buffer and replaced there by the next item of the input.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randint(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def iter_in_process(gen_fn, args, chunksize=256, maxsize=8):
+    """
+    Run the generator gen_fn(*args) in a separate process and yield its items. Items are passed in chunks through
+    a bounded queue, so the process stays at most maxsize chunks ahead of the consumer.
+    """
+    queue = multiprocessing.Queue(maxsize)
+    proc = multiprocessing.Process(target=put_chunks, args=(gen_fn, args, queue, chunksize), daemon=True)
+    proc.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            for item in chunk:
+                yield item
+    finally:
+        proc.terminate()
+        proc.join()
+
+
+def put_chunks(gen_fn, args, queue, chunksize):
+    try:
+        items = gen_fn(*args)
+        while True:
+            chunk = list(islice(items, chunksize))
+            if not chunk:
+                break
+            queue.put(chunk)
+    except Exception as e:
+        queue.put(e)
+    queue.put(None)
+
+
+def load_data_clicr_kv(data_dir, ent_setup, log, win_size=3, max_n_load=None, max_vocab_size=None, min_freq=1, vocab=None):
     #train_data, _ = load_clicr_ent_only(data_dir + "train1.0.json", ent_setup, max_n_load=max_n_load)
     train_data = load_clicr_kv(data_dir + "train1.0.json", win_size=win_size, ent_setup=ent_setup, max_n_load=max_n_load)
     val_data = load_clicr_kv(data_dir + "dev1.0.json", win_size=win_size, ent_setup=ent_setup, remove_notfound=False, max_n_load=max_n_load)
     test_data = load_clicr_kv(data_dir + "test1.0.json", win_size=win_size, ent_setup=ent_setup, remove_notfound=False, max_n_load=max_n_load)
 
-    data = train_data + val_data + test_data  # TODO exclude test?
-
-    vocab_set = set()
-    for (k,v), q, a, _, _, _ in data:
-        vocab_set.update([w for sent in k for w in sent] + v + q + a)
-
-    vocab = sorted(vocab_set)
+    if vocab is None:
+        vocab = build_vocab([train_data, val_data, test_data], max_vocab_size, min_freq)  # TODO exclude test?
 
     return train_data, val_data, test_data, vocab
 
@@ -726,6 +1149,94 @@ def load_json(filename):
         return json.load(in_f)
 
 
+class _JSONStream(object):
+    """
+    Incremental reader over a JSON file: values are decoded one at a time from a buffer that only holds
+    the part of the file that has not been consumed yet.
+    """
+    _ws = re.compile(r"\s*")
+
+    def __init__(self, in_f, chunk_size):
+        self.in_f = in_f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # read at least as much as is pending, so that decoding a large value is retried a logarithmic number of times
+        chunk = self.in_f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or "" at the end of the file.
+        """
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of '{}' at '{}' in {}".format(chars, c, self.in_f.name))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if isinstance(obj, (int, float)) and not self.eof and \
+                    (end == len(self.buf) or self.buf[end] in "0123456789.eE+-") and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_json_data(filename, key=DATA_KEY, chunk_size=1 << 16):
+    """
+    Yield the elements of the top-level list raw[key] one at a time, without loading the whole file.
+    Peak memory is set by the largest element rather than by the file size, and reading stops as soon
+    as the caller stops iterating.
+    """
+    with open(filename) as in_f:
+        stream = _JSONStream(in_f, chunk_size)
+        stream.expect("{")
+        if stream.peek() == "}":
+            raise KeyError(key)
+        while True:
+            k = stream.value()
+            stream.expect(":")
+            if k == key:
+                stream.expect("[")
+                if stream.peek() == "]":
+                    return
+                while True:
+                    yield stream.value()
+                    if stream.expect(",]") == "]":
+                        return
+            else:
+                stream.value()
+            if stream.expect(",}") == "}":
+                raise KeyError(key)
+
+
 def save_json(obj, filename):
     with open(filename, "w") as out:
         json.dump(obj, out, separators=(',', ':'))
@@ -733,9 +1244,7 @@ def save_json(obj, filename):
 
 def get_q_ids_clicr(fn):
     q_ids = set()
-    dataset = load_json(fn)
-    data = dataset[DATA_KEY]
-    for datum in data:
+    for datum in iter_json_data(fn):
         for qa in datum[DOC_KEY][QAS_KEY]:
             q_ids.add(qa[ID_KEY])
 
@@ -781,17 +1290,24 @@ def remove_missing_preds(fn, predictions):
 
 def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
     questions = []
-    raw = load_json(fn)
     relabeling_dicts = {}
-    for c, datum in enumerate(raw[DATA_KEY]):
-        sents = []
-        for sent in (datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]).split("\n"):
-            if sent:
-                sents.append(to_entities(sent).lower())
-        document = " ".join(sents)
+    for c, datum in enumerate(iter_json_data(fn)):
+        doc_txt = datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]
+        if ent_setup == "no-ent":
+            # collect candidate ents using @entity marks
+            cand_e = EntityIndex(to_entities(doc_txt).lower().split()).candidates()
+            cand_raw = [e[len("@entity"):].split("_") for e in cand_e]
+            sents = [remove_entity_marks(sent).lower() for sent in doc_txt.split("\n") if sent]
+        else:
+            sents = [to_entities(sent).lower() for sent in doc_txt.split("\n") if sent]
+        # shared by the questions of the document
+        story = [sent.split() for sent in sents]
+        doc_index = EntityIndex(" ".join(sents).split())
+        if ent_setup == "ent":
+            cand_raw = [[e] for e in doc_index.candidates()]
+
         for qa in datum[DOC_KEY][QAS_KEY]:
             if ent_setup in ["ent-anonym", "ent"]:
-                doc_raw = document.split()
                 question = to_entities(qa[QUERY_KEY]).lower()
                 qry_id = qa[ID_KEY]
                 assert question
@@ -801,12 +1317,12 @@ def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
                         ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
                 assert ans_raw
                 if remove_notfound:  # should be always false for dev and test
-                    if ans_raw not in doc_raw:
+                    if ans_raw not in doc_index:
                         found_umls = False
                         for ans in qa[ANS_KEY]:
                             if ans[ORIG_KEY] == "UMLS":
                                 umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-                                if umls_answer in doc_raw:
+                                if umls_answer in doc_index:
                                     found_umls = True
                                     ans_raw = umls_answer
                         if not found_umls:
@@ -815,21 +1331,18 @@ def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
                 if ent_setup == "ent-anonym":
                     entity_dict = {}
                     entity_id = 0
-                    lst = doc_raw + qry_raw
-                    lst.append(ans_raw)
-                    for word in lst:
+                    # the document entities come first, in order of occurrence
+                    for word in chain(doc_index.candidates(), qry_raw, [ans_raw]):
                         if (word.startswith('@entity')) and (word not in entity_dict):
                             entity_dict[word] = '@entity' + str(entity_id)
                             entity_id += 1
                     qry_raw = [entity_dict[w] if w in entity_dict else w for w in qry_raw]
-                    doc_raw = [entity_dict[w] if w in entity_dict else w for w in doc_raw]
                     ans_raw = entity_dict[ans_raw]
+                    cand_raw = [[entity_dict[e]] for e in doc_index.candidates()]
                     inv_entity_dict = {ent_id: ent_ans for ent_ans, ent_id in entity_dict.items()}
                     assert len(entity_dict) == len(inv_entity_dict)
                     relabeling_dicts[qa[ID_KEY]] = inv_entity_dict
 
-                cand_e = [w for w in doc_raw if w.startswith('@entity')]
-                cand_raw = [[e] for e in cand_e]
                 # wrap the query with special symbols
                 qry_raw.insert(0, SYMB_BEGIN)
                 qry_raw.append(SYMB_END)
@@ -841,24 +1354,9 @@ def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
                     qry_raw = qry_raw[:at] + [''.join(qry_raw[at:at + 2])] + qry_raw[at + 2:]
                     cloze = qry_raw.index('@placeholder')
 
-                questions.append(([sent.split() for sent in sents], qry_raw, [ans_raw], cand_raw, cloze, qry_id))
+                questions.append((story, qry_raw, [ans_raw], cand_raw, cloze, qry_id))
 
             elif ent_setup == "no-ent":
-                # collect candidate ents using @entity marks
-                cand_e = [w for w in
-                          to_entities(datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]).lower().split() if
-                          w.startswith('@entity')]
-                cand_raw = [e[len("@entity"):].split("_") for e in cand_e]
-                # document = remove_entity_marks(datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY])
-                # document = document.lower()
-                # doc_raw = document.split()
-                # sents = document.split("\n")
-                sents = []
-                for sent in (datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]).split("\n"):
-                    if sent:
-                        sents.append(remove_entity_marks(sent).lower())
-                document = " ".join(sents)
-                doc_raw = document.split()
                 question = remove_entity_marks(qa[QUERY_KEY]).lower()
                 qry_id = qa[ID_KEY]
                 assert question
@@ -869,12 +1367,12 @@ def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
                         ans_raw = ans[TXT_KEY].lower()
                 assert ans_raw
                 if remove_notfound:
-                    if ans_raw not in doc_raw:
+                    if ans_raw not in doc_index:
                         found_umls = False
                         for ans in qa[ANS_KEY]:
                             if ans[ORIG_KEY] == "UMLS":
                                 umls_answer = ans[TXT_KEY].lower()
-                                if umls_answer in doc_raw:
+                                if umls_answer in doc_index:
                                     found_umls = True
                                     ans_raw = umls_answer
                         if not found_umls:
@@ -892,7 +1390,7 @@ def load_clicr(fn, ent_setup="ent", remove_notfound=True, max_n_load=None):
                     qry_raw = qry_raw[:at] + [''.join(qry_raw[at:at + 2])] + qry_raw[at + 2:]
                     cloze = qry_raw.index('@placeholder')
 
-                questions.append(([sent.split() for sent in sents], qry_raw, [ans_raw], cand_raw, cloze, qry_id))
+                questions.append((story, qry_raw, [ans_raw], cand_raw, cloze, qry_id))
             else:
                 raise ValueError
         if max_n_load is not None and c > max_n_load:
@@ -905,19 +1403,20 @@ def load_clicr_ent_only(fn, ent_setup="ent", remove_notfound=True, max_n_load=No
     only entities as text
     """
     questions = []
-    raw = load_json(fn)
     relabeling_dicts = {}
-    for c, datum in enumerate(raw[DATA_KEY]):
+    for c, datum in enumerate(iter_json_data(fn)):
         sents = []
         for sent in (datum[DOC_KEY][TITLE_KEY] + "\n" + datum[DOC_KEY][CONTEXT_KEY]).split("\n"):
             if sent:
                 ent_sent = " ".join([w for w in to_entities(sent).lower().split(" ") if w.startswith("@entity")])
                 if ent_sent:
                     sents.append(ent_sent)
-        document = " ".join(sents)
+        # shared by the questions of the document
+        story = [sent.split() for sent in sents]
+        doc_index = EntityIndex(" ".join(sents).split())
+        cand_raw = [[e] for e in doc_index.candidates()]
         for qa in datum[DOC_KEY][QAS_KEY]:
             if ent_setup in ["ent"]:
-                doc_raw = document.split()
                 question = " ".join([w for w in to_entities(qa[QUERY_KEY]).lower().split(" ") if w.startswith("@entity") or w.startswith("@placeholder")])
                 if not question:
                     continue
@@ -929,20 +1428,18 @@ def load_clicr_ent_only(fn, ent_setup="ent", remove_notfound=True, max_n_load=No
                         ans_raw = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
                 assert ans_raw
                 if remove_notfound:  # should be always false for dev and test
-                    if ans_raw not in doc_raw:
+                    if ans_raw not in doc_index:
                         found_umls = False
                         for ans in qa[ANS_KEY]:
                             if ans[ORIG_KEY] == "UMLS":
                                 umls_answer = ("@entity" + "_".join(ans[TXT_KEY].split())).lower()
-                                if umls_answer in doc_raw:
+                                if umls_answer in doc_index:
                                     found_umls = True
                                     ans_raw = umls_answer
                         if not found_umls:
                             continue
                 qry_raw = question.split()
 
-                cand_e = [w for w in doc_raw if w.startswith('@entity')]
-                cand_raw = [[e] for e in cand_e]
                 # wrap the query with special symbols
                 qry_raw.insert(0, SYMB_BEGIN)
                 qry_raw.append(SYMB_END)
@@ -954,7 +1451,7 @@ def load_clicr_ent_only(fn, ent_setup="ent", remove_notfound=True, max_n_load=No
                     qry_raw = qry_raw[:at] + [''.join(qry_raw[at:at + 2])] + qry_raw[at + 2:]
                     cloze = qry_raw.index('@placeholder')
 
-                questions.append(([sent.split() for sent in sents], qry_raw, [ans_raw], cand_raw, cloze, qry_id))
+                questions.append((story, qry_raw, [ans_raw], cand_raw, cloze, qry_id))
             else:
                 raise ValueError
         if max_n_load is not None and c > max_n_load:
@@ -983,19 +1480,36 @@ def process_inst_cbt(i):
         return (sents, q, a, cands)
 
 
-def read_cbt(fn, lowercase=True):
-    def to_lower(s, low):
-        return s.lower() if low else s
-
-    proc_insts = []
+def read_cbt(fn, lowercase=True, max_n_load=None):
+    """
+    Yield the instances of a CBT file as returned by process_inst_cbt. The file is read one instance (a block
+    of lines ending in a blank line) at a time, and reading stops after max_n_load instances.
+    """
+    n_inst = 0
     with open(fn) as f:
-        raw_insts = to_lower(f.read(), lowercase).split("\n\n")
-        for i in tqdm(raw_insts):
-            inst = process_inst_cbt(i)
+        for i in tqdm(iter_blocks(f)):
+            inst = process_inst_cbt(i.lower() if lowercase else i)
             if inst is not None:
-                proc_insts.append(inst)
-    print("\nn inst {}: {}".format(fn, len(proc_insts)))
-    return proc_insts
+                yield inst
+                n_inst += 1
+                if max_n_load is not None and n_inst >= max_n_load:
+                    break
+    print("\nn inst {}: {}".format(fn, n_inst))
+
+
+def iter_blocks(f):
+    """
+    Yield the "\n\n"-separated blocks of an open text file, as str.split("\n\n") on its contents would up
+    to leading and trailing newlines.
+    """
+    block = []
+    for line in f:
+        if line == "\n":
+            yield "".join(block)
+            block = []
+        else:
+            block.append(line)
+    yield "".join(block)
 
 
 def get_win(sent, cands, win_size=3, include_cand=True):
@@ -1012,28 +1526,30 @@ def get_win(sent, cands, win_size=3, include_cand=True):
             yield win, w
 
 
-def load_cbt_win(fn, ent_setup="ent", max_n_load=None, win_size=3, include_cand=True):
-    questions = []
-    insts = read_cbt(fn)
+def load_cbt_win(fn, ent_setup="ent", max_n_load=None, win_size=3, include_cand=True, n_workers=1):
+    insts = read_cbt(fn, max_n_load=max_n_load + 2 if max_n_load is not None else None)
     relabeling_dicts = {}
-    #max_mem_size = 0
-    for c, inst in enumerate(insts):
-        sents, q, a, cands = inst
-        wins = [(win, w) for s in sents for win, w in get_win(s.split(), set(cands), win_size=win_size, include_cand=include_cand)]
-        #if len(wins)> max_mem_size:
-        #    max_mem_size = len(wins)
-        q_win = next(get_win(q.split(), {"xxxxx"}, win_size=win_size, include_cand=include_cand))
-        cloze = q.index("xxxxx")
-        if include_cand:
-            wins = [win for win, w in wins]
-            q_win = q_win[0]
-        questions.append((wins, q_win, [a], [[c] for c in cands], cloze, c))
-        if max_n_load is not None and c > max_n_load:
-            break
-    #print("maximum memory size in {}: {}".format(os.path.basename(fn), max_mem_size))
+    process_inst = functools.partial(process_inst_cbt_win, win_size=win_size, include_cand=include_cand)
+    questions = list(map_docs(process_inst, enumerate(insts), n_workers, chunksize=256))
+
     return questions, relabeling_dicts
 
 
+def process_inst_cbt_win(c_inst, win_size=3, include_cand=True):
+    """
+    :param c_inst: (instance number, instance as returned by process_inst_cbt)
+    """
+    c, (sents, q, a, cands) = c_inst
+    wins = [(win, w) for s in sents for win, w in get_win(s.split(), set(cands), win_size=win_size, include_cand=include_cand)]
+    q_win = next(get_win(q.split(), {"xxxxx"}, win_size=win_size, include_cand=include_cand))
+    cloze = q.index("xxxxx")
+    if include_cand:
+        wins = [win for win, w in wins]
+        q_win = q_win[0]
+
+    return wins, q_win, [a], [[c] for c in cands], cloze, c
+
+
 def remove_entity_marks(txt):
     return txt.replace("BEG__", "").replace("__END", "")
 
@@ -1042,34 +1558,40 @@ def to_entities(text):
     """
     Text includes entities marked as BEG__w1 w2 w3__END. Transform to a single entity @entityw1_w2_w3.
     """
+    tokens = text.split()
+    if "__" not in text:
+        return " ".join(tokens)
+
     word_list = []
     inside = False
     concept = None
-    for w in text.split():
-        w_stripped = w.strip()
-        if w_stripped.startswith("BEG__") and w_stripped.endswith("__END"):
-            concept = [w_stripped.split("_")[2]]
+    for w in tokens:
+        if "__" not in w:
+            if inside:
+                concept.append(w)
+            else:
+                word_list.append(w)
+        elif w.startswith("BEG__") and w.endswith("__END"):
+            concept = [w.split("_")[2]]
             word_list.append("@entity" + "_".join(concept))
             if inside:  # something went wrong, leave as is
                 print("Inconsistent markup.")
-        elif w_stripped.startswith("BEG__"):
+        elif w.startswith("BEG__"):
             assert not inside
             inside = True
-            concept = [w_stripped.split("_", 2)[-1]]
-        elif w_stripped.endswith("__END"):
+            concept = [w.split("_", 2)[-1]]
+        elif w.endswith("__END"):
             if not inside:
                 # add incorrectly parsed concept, but without entity marking
-                word_list.append(w_stripped.rsplit("_", 2)[0])
+                word_list.append(w.rsplit("_", 2)[0])
                 continue
-            assert inside
-            concept.append(w_stripped.rsplit("_", 2)[0])
+            concept.append(w.rsplit("_", 2)[0])
             word_list.append("@entity" + "_".join(concept))
             inside = False
+        elif inside:
+            concept.append(w)
         else:
-            if inside:
-                concept.append(w_stripped)
-            else:
-                word_list.append(w_stripped)
+            word_list.append(w)
     if concept and inside:
         # add incorrectly parsed concept, but without entity marking
         word_list.extend(concept)
@@ -1077,7 +1599,7 @@ def to_entities(text):
     return " ".join(word_list)
 
 
-def load_data(data_dir, joint_training, task_number):
+def load_data(data_dir, joint_training, task_number, max_vocab_size=None, min_freq=1, vocab=None):
     if (joint_training == 0):
         start_task = task_number
         end_task = task_number
@@ -1097,14 +1619,14 @@ def load_data(data_dir, joint_training, task_number):
     np.random.shuffle(train_data)
     val_size = int(len(train_data)*0.1)
     val_data, train_data = train_data[:val_size], train_data[val_size:]
-    data = train_data + val_data + test_data
 
-    vocab = sorted(reduce(lambda x, y: x | y, (set(list(chain.from_iterable(s)) + q + a) for s, q, a, _, _, _ in data)))
+    if vocab is None:
+        vocab = build_vocab([train_data, val_data, test_data], max_vocab_size, min_freq)
 
     return train_data, val_data, test_data, vocab
 
 
-def load_data_kv(data_dir, joint_training, task_number, win_size):
+def load_data_kv(data_dir, joint_training, task_number, win_size, max_vocab_size=None, min_freq=1, vocab=None):
     if (joint_training == 0):
         start_task = task_number
         end_task = task_number
@@ -1121,14 +1643,8 @@ def load_data_kv(data_dir, joint_training, task_number, win_size):
         test_data += task_test
         start_task += 1
 
-    data = train_data + test_data
-
-    #vocab = sorted(reduce(lambda x, y: x | y, (set(list(chain.from_iterable(s)) + q + a) for (k, v), q, a in data)))
-    vocab_set = set()
-    for (k, v), q, a in data:
-        vocab_set.update([w for sent in k for w in sent] + v + q + a)
-
-    vocab = sorted(vocab_set)
+    if vocab is None:
+        vocab = build_vocab([train_data, test_data], max_vocab_size, min_freq)
 
     return train_data, test_data, vocab
 
@@ -1216,116 +1732,88 @@ def tokenize(sent):
     >>> tokenize('Bob dropped the apple. Where is the apple?')
     ['Bob', 'dropped', 'the', 'apple', '.', 'Where', 'is', 'the', 'apple', '?']
     '''
-    return [x.strip() for x in re.split('(\W+)?', sent) if x.strip()]
+    return [x.strip() for x in _TOKENIZE_RE.split(sent) if x.strip()]
 
 
-def calculate_parameter_values(data, debug, memory_size, vocab, log):
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    max_story_size = max(map(len, (s for s, _, _, _, _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (s for s, _, _, _, _, _ in data)))))
-    sentence_size = max(map(len, chain.from_iterable(s for s, _, _, _, _, _ in data)))
-    query_size = max(map(len, (q for _, q, _, _, _, _ in data)))
-    memory_size = min(memory_size, max_story_size)
-    vocab_size = len(word_idx) + 1  # +1 for nil word
-    sentence_size = max(query_size, sentence_size)  # for the position
-    if debug:
-        log.info("Longest sentence length: {}".format(sentence_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
-        log.info("Average memory size: {}".format(memory_size))
-    return memory_size, sentence_size, vocab_size, word_idx
+class DatasetStats(object):
+    """
+    Length histograms of the stories, their sentences (windows, keys) and the queries of a dataset, collected in
+    one pass over its instances.
+    """
+    def __init__(self):
+        self.n = 0
+        self.story_sizes = Counter()
+        self.sentence_sizes = Counter()
+        self.query_sizes = Counter()
+
+    def update(self, data):
+        # plain dicts while counting, they are faster to increment than Counters
+        story_sizes = defaultdict(int)
+        query_sizes = defaultdict(int)
+        passages = defaultdict(int)
+
+        def stories():
+            for inst in data:
+                story = inst[0]
+                if isinstance(story, tuple):  # keys of (keys, values)
+                    story = story[0]
+                story_sizes[len(story)] += 1
+                query_sizes[len(inst[1])] += 1
+                if isinstance(story, Passage):
+                    passages[story] += 1
+                else:
+                    yield story
 
+        # the sentences are measured in the same pass over data
+        sentence_sizes = np.bincount(np.fromiter(map(len, chain.from_iterable(stories())), dtype=np.int64))
+        for size in np.flatnonzero(sentence_sizes):
+            self.sentence_sizes[int(size)] += int(sentence_sizes[size])
+        # shared by several instances, so the sentences of a passage are measured once
+        for passage, n in passages.items():
+            for size, f in Counter(map(len, passage)).items():
+                self.sentence_sizes[size] += f * n
+        self.story_sizes.update(story_sizes)
+        self.query_sizes.update(query_sizes)
+        self.n += sum(story_sizes.values())
 
-def calculate_parameter_values_kv(data, debug, memory_size, vocab, log):
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    max_story_size = max(map(len, (k for (k,v), _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (k for (k,v), _, _ in data)))))
-    k_size = max(map(len, chain.from_iterable(k for (k,v), _, _ in data)))
-    v_size = None
-    memory_size = min(memory_size, max_story_size)
-    vocab_size = len(word_idx) + 1  # +1 for nil word
-    if debug:
-        log.info("Longest key length: {}".format(k_size))
-        log.info("Longest value length: {}".format(v_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
-        log.info("Average memory size: {}".format(memory_size))
-    return memory_size, k_size, v_size, vocab_size, word_idx
+    @property
+    def max_story_size(self):
+        return max(self.story_sizes)
 
+    @property
+    def mean_story_size(self):
+        return sum(size * n for size, n in self.story_sizes.items()) / self.n
 
-def calculate_parameter_values_clicr(data, debug, memory_size, vocab, log):
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    output_idx = dict()
-    i = 0
-    for w in vocab:
-        if w.startswith("@entity"):
-            output_idx[w] = i
-            i += 1
-    max_story_size = max(map(len, (s for s, _, _, _, _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (s for s, _, _, _, _, _ in data)))))
-    sentence_size = max(map(len, chain.from_iterable(s for s, _, _, _, _, _ in data)))
-    query_size = max(map(len, (q for _, q, _, _, _, _ in data)))
-    memory_size = min(memory_size, max_story_size)
-    vocab_size = len(word_idx) + 1  # +1 for nil word
-    output_size = len(output_idx)
-    sentence_size = max(query_size, sentence_size)  # for the position
-    if debug is True:
-        log.info("Longest sentence length: {}".format(sentence_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
-        log.info("Average memory size: {}".format(memory_size))
-    return memory_size, sentence_size, vocab_size, word_idx, output_size, output_idx
+    @property
+    def sentence_size(self):
+        return max(self.sentence_sizes)
 
+    @property
+    def query_size(self):
+        return max(self.query_sizes)
 
-def calculate_parameter_values_clicr_win(data, debug, memory_size, vocab, log):
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    output_idx = dict()
-    i = 0
-    for w in vocab:
-        if w.startswith("@entity"):
-            output_idx[w] = i
-            i += 1
-    max_story_size = max(map(len, (s for s, _, _, _, _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (s for s, _, _, _, _, _ in data)))))
-    sentence_size = max(map(len, chain.from_iterable(s for s, _, _, _, _, _ in data)))
-    query_size = max(map(len, (q for _, q, _, _, _, _ in data)))
-    memory_size = min(memory_size, max_story_size)
-    vocab_size = len(word_idx) + 1  # +1 for nil word
-    output_size = len(output_idx)
-    sentence_size = max(query_size, sentence_size)  # for the position
-    if debug is True:
-        log.info("Longest sentence length: {}".format(sentence_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
-        log.info("Average memory size: {}".format(memory_size))
-    return memory_size, sentence_size, vocab_size, word_idx, output_size, output_idx
+    def report(self, log):
+        log.info("Longest sentence length: {}".format(self.sentence_size))
+        log.info("Longest query length: {}".format(self.query_size))
+        log.info("Longest story length: {}".format(self.max_story_size))
+        log.info("Average story length: {}".format(int(self.mean_story_size)))
+        for name, hist in (("Story", self.story_sizes), ("Sentence", self.sentence_sizes), ("Query", self.query_sizes)):
+            log.info("{} length histogram (length: count): {}".format(name, sorted(hist.items())))
 
 
-def calculate_parameter_values_cbt_win(data, debug, memory_size, vocab, log):
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    #output_idx = dict()
-    #i = 0
-    #for w in vocab:
-    #    if w.startswith("@entity"):
-    #        output_idx[w] = i
-    #        i += 1
-    max_story_size = max(map(len, (s for s, _, _, _, _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (s for s, _, _, _, _, _ in data)))))
-    sentence_size = max(map(len, chain.from_iterable(s for s, _, _, _, _, _ in data)))
-    query_size = max(map(len, (q for _, q, _, _, _, _ in data)))
-    memory_size = min(memory_size, max_story_size)
-    vocab_size = len(word_idx) + 1  # +1 for nil word
-    #output_size = len(output_idx)
-    sentence_size = max(query_size, sentence_size)  # for the position
-    if debug is True:
-        log.info("Longest sentence length: {}".format(sentence_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
-        log.info("Average memory size: {}".format(memory_size))
-    return memory_size, sentence_size, vocab_size, word_idx
+def collect_stats(data):
+    stats = DatasetStats()
+    stats.update(data)
+
+    return stats
 
 
-def calculate_parameter_values_clicr_kv(data, debug, memory_size, vocab, log):
+def calculate_parameter_values(stats, debug, memory_size, vocab, log):
+    """
+    :param stats: DatasetStats of the training data
+    :return: memory_size, vocab_size, word_idx, output_size, output_idx. The outputs are the @entity words, as
+    used for CliCR.
+    """
     word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
     output_idx = dict()
     i = 0
@@ -1333,23 +1821,43 @@ def calculate_parameter_values_clicr_kv(data, debug, memory_size, vocab, log):
         if w.startswith("@entity"):
             output_idx[w] = i
             i += 1
-    max_story_size = max(map(len, (k for (k,v), _, _, _, _, _ in data)))
-    mean_story_size = int(np.mean(list(map(len, (k for (k,v), _, _, _, _, _ in data)))))
-    k_size = max(map(len, chain.from_iterable(k for (k,v), _, _, _, _, _ in data)))
-    #v_size = max(map(len, chain.from_iterable(v for (k,v), _, _, _, _, _ in data)))
-    v_size = None
-    query_size = max(map(len, (q for _, q, _, _, _, _ in data)))
-    memory_size = min(memory_size, max_story_size)
+    memory_size = min(memory_size, stats.max_story_size)
     vocab_size = len(word_idx) + 1  # +1 for nil word
     output_size = len(output_idx)
-    #sentence_size = max(query_size, k_size)  # for the position
-    if debug is True:
-        log.info("Longest key length: {}".format(k_size))
-        log.info("Longest value length: {}".format(v_size))
-        log.info("Longest story length: {}".format(max_story_size))
-        log.info("Average story length: {}".format(mean_story_size))
+    if debug:
+        stats.report(log)
         log.info("Memory size: {}".format(memory_size))
-    return memory_size, k_size, v_size, vocab_size, word_idx, output_size, output_idx
+    return memory_size, vocab_size, word_idx, output_size, output_idx
+
+
+class WordLookup(object):
+    """
+    Arrays indexed by word id, built once from word_idx and output_idx: the output id of each word (-1 if it is
+    not an output, as for the nil word 0) and whether it is an @entity word.
+    """
+    def __init__(self, word_idx, output_idx):
+        self.word_idx = word_idx
+        self.output_idx = output_idx
+        size = max(word_idx.values(), default=0) + 1
+        self.output_ids = np.full(size, -1, dtype=np.int64)
+        self.is_entity = np.zeros(size, dtype=bool)
+        for w, i in word_idx.items():
+            if output_idx is not None and w in output_idx:
+                self.output_ids[i] = output_idx[w]
+            self.is_entity[i] = w.startswith("@entity")
+
+
+_word_lookup = None
+
+
+def word_lookup(word_idx, output_idx):
+    """
+    :return: the WordLookup of word_idx and output_idx, reused as long as the same dictionaries are passed
+    """
+    global _word_lookup
+    if _word_lookup is None or _word_lookup.word_idx is not word_idx or _word_lookup.output_idx is not output_idx:
+        _word_lookup = WordLookup(word_idx, output_idx)
+    return _word_lookup
 
 
 def vectorize_task_data(batch_size, data, debug, memory_size, random_state, sentence_size, test,
@@ -1376,9 +1884,9 @@ def vectorize_task_data(batch_size, data, debug, memory_size, random_state, sent
         log.info("Training Size: {}".format(n_train))
         log.info("Validation Size: {}".format(n_val))
         log.info("Testing Size: {}".format(n_test))
-    train_labels = np.argmax(trainY, axis=1)
-    test_labels = np.argmax(testY, axis=1)
-    val_labels = np.argmax(valY, axis=1)
+    train_labels = trainY
+    test_labels = testY
+    val_labels = valY
     n_train_labels = train_labels.shape[0]
     n_val_labels = val_labels.shape[0]
     n_test_labels = test_labels.shape[0]
@@ -1396,6 +1904,45 @@ def vectorize_task_data(batch_size, data, debug, memory_size, random_state, sent
            list(test_batches)
 
 
+def top_memories(ms, q, memory_size):
+    """
+    Select the memories to keep when there are more than memory_size. A memory (sentence, key or window as word
+    ids) is scored by the number of positions at which it has the same word id as the query q. Ties go to the
+    earlier memory.
+
+    :return: ids of the memory_size best-scoring memories, in their original order
+    """
+    ms = np.array(ms)
+    n = min(ms.shape[1], len(q))
+    scores = (ms[:, :n] == np.array(q[:n])).sum(axis=1)
+    keys = scores * len(ms) + np.arange(len(ms) - 1, -1, -1)  # unique, so the selection is deterministic
+    return np.sort(np.argpartition(-keys, memory_size - 1)[:memory_size])
+
+
+def csr_rows(rows):
+    """
+    :param rows: lists of column ids
+    :return: (indptr, indices) as in a CSR matrix: the ids of row i are indices[indptr[i]:indptr[i + 1]]
+    """
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=indptr[1:])
+    return indptr, np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=indptr[-1])
+
+
+def length_mask(lengths, size):
+    """
+    :return: for each length, a row of size with ones at the first length positions and zeros after
+    """
+    return (np.arange(size) < np.array(lengths).reshape(-1, 1)).astype(float)
+
+
+def answer_id(answer, idx):
+    """
+    :return: the id of the answer, the target of the loss; the lowest one if there are several
+    """
+    return min((idx[a] for a in answer), default=0)
+
+
 def vectorize_data(data, word_idx, sentence_size, memory_size):
     '''
     Vectorize stories and queries.
@@ -1405,7 +1952,7 @@ def vectorize_data(data, word_idx, sentence_size, memory_size):
     If a story length < memory_size, the story will be padded with empty memories.
     Empty memories are 1-D arrays of length sentence_size filled with 0's.
 
-    The answer array is returned as a one-hot encoding.
+    The answers are returned as their word ids.
 
     '''
     S = []
@@ -1416,40 +1963,33 @@ def vectorize_data(data, word_idx, sentence_size, memory_size):
     SL = None  # sentences lengths
     QL = None  # query lengths
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for story, query, answer in data:
         lq = max(0, sentence_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ss = []
         for i, sentence in enumerate(story, 1):
             ls = max(0, sentence_size - len(sentence))
-            ss.append([word_idx[w] for w in sentence] + [0] * ls)
+            ss.append([word_idx.get(w, unk) for w in sentence] + [0] * ls)
 
         if len(ss) > memory_size:
 
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ss, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ss) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                ss.remove(sent)
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ss, q, memory_size)
+            ss = [ss[i] for i in keep]
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ss))
             for _ in range(lm):
                 ss.append([0] * sentence_size)
 
-        y = np.zeros(len(word_idx) + 1)  # 0 is reserved for nil word
-        for a in answer:
-            y[word_idx[a]] = 1
+        y = answer_id(answer, word_idx)
 
         S.append(ss)
         Q.append(q)
         A.append(y)
-    return np.array(S), np.array(Q), np.array(A), VM, PL, SL, QL
+    return np.array(S), np.array(Q), np.array(A, dtype=np.int64), VM, PL, SL, QL
 
 
 def vectorize_data_clicr(data, word_idx, output_size, output_idx, sentence_size, memory_size):
@@ -1461,7 +2001,7 @@ def vectorize_data_clicr(data, word_idx, output_size, output_idx, sentence_size,
     If a story length < memory_size, the story will be padded with empty memories.
     Empty memories are 1-D arrays of length sentence_size filled with 0's.
 
-    The answer array is returned as a one-hot encoding.
+    The answers are returned as their output ids.
 
     vocab_mask marks which elements (=words/entities) in V are found in the particular document
 
@@ -1473,20 +2013,20 @@ def vectorize_data_clicr(data, word_idx, output_size, output_idx, sentence_size,
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    SM = []  # sentences mask
-    QM = []  # query mask
-    inv_w_idx = {v: k for k, v in word_idx.items()}
+    PL = []  # passage lengths
+    output_ids = word_lookup(word_idx, output_idx).output_ids
+    story_voc = {}  # output ids of the stories kept whole
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for story, query, answer, _, _, _ in data:
         lq = max(0, sentence_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ss = []
         #ss_len = []
         for sentence in story:
             ls = max(0, sentence_size - len(sentence))
-            sent = [word_idx[w] for w in sentence] + [0] * ls
+            sent = [word_idx.get(w, unk) for w in sentence] + [0] * ls
             #sent_m = [1.] * len(sentence) + [0.] * ls
             if len(sent) > sentence_size:  # can happen in test/val as sentence_size is calculated on train
                 sent = sent[:sentence_size]
@@ -1494,49 +2034,46 @@ def vectorize_data_clicr(data, word_idx, output_size, output_idx, sentence_size,
             ss.append(sent)
             #ss_len.append(sent_m)
 
-        if len(ss) > memory_size:
+        pruned = len(ss) > memory_size
+        if pruned:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ss, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ss) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                #del_id = ss.index(sent)
-                ss.remove(sent)
-                #del ss_len[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ss, q, memory_size)
+            ss = [ss[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ss))
-            p_m = [1.] * len(ss) + [0.] * lm
+            PL.append(len(ss))
             for _ in range(lm):
                 ss.append([0] * sentence_size)
                 #ss_len.append([0.] * sentence_size)
-        y = np.zeros(output_size)
-        #y = np.zeros(len(word_idx)+1)
-        for a in answer:
-            y[output_idx[a]] = 1
-            #y[word_idx[a]] = 1
+        y = answer_id(answer, output_idx)
 
-        vm = np.zeros_like(y)
         # mask for all words in vocab not part of the entities in the passage:
         # TODO this doesn't work for the no-ent setting
-        ss_voc = {output_idx[inv_w_idx[i]] for i in set(np.array(ss).flatten()) if i!=0 and inv_w_idx[i] in output_idx}
+        if pruned:
+            ss_voc = window_output_ids(ss, output_ids)
+        else:  # the questions of a document share its story, whose mask is computed once
+            if id(story) not in story_voc:
+                story_voc[id(story)] = window_output_ids(ss, output_ids)
+            ss_voc = story_voc[id(story)]
         #ss_voc = {word_idx[inv_w_idx[i]] for i in set(np.array(ss).flatten()) if i != 0 and inv_w_idx[i] in word_idx}
-        vm[list(ss_voc)] = 1.
+        vm = sorted(ss_voc)
 
         S.append(ss)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        SM = np.clip(np.array(S), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(S), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(SM), np.array(QM)
+    S = np.array(S)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    SM = np.clip(S, 0., 1.)  # sentences mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return S, Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, SM, QM
 
 def vectorize_data_clicr_kv(data, word_idx, output_size, output_idx, k_size, memory_size):
     '''
@@ -1547,7 +2084,7 @@ def vectorize_data_clicr_kv(data, word_idx, output_size, output_idx, k_size, mem
     If a story length < memory_size, the story will be padded with empty memories.
     Empty memories are 1-D arrays of length sentence_size filled with 0's.
 
-    The answer array is returned as a one-hot encoding.
+    The answers are returned as their output ids.
 
     vocab_mask marks which elements (=words/entities) in V are found in the particular document
 
@@ -1560,68 +2097,60 @@ def vectorize_data_clicr_kv(data, word_idx, output_size, output_idx, k_size, mem
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    KM = []  # keys mask
-    QM = []  # query mask
-    inv_w_idx = {v: k for k, v in word_idx.items()}
+    PL = []  # passage lengths
+    output_ids = word_lookup(word_idx, output_idx).output_ids
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for (k,v), query, answer, _, _, _ in data:
         lq = max(0, k_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ks = []
         for win in k:
             ls = max(0, k_size - len(win))
-            sent = [word_idx[w] for w in win] + [0] * ls
+            sent = [word_idx.get(w, unk) for w in win] + [0] * ls
             if len(sent) > k_size:  # can happen in test/val as sentence_size is calculated on train
                 sent = sent[:k_size]
             ks.append(sent)
 
-        vs = [word_idx[val] for val in v]
+        vs = [word_idx.get(val, unk) for val in v]
 
         assert len(ks) == len(vs)
         if len(ks) > memory_size:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ks, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ks) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                del_id = ks.index(sent)
-                del ks[del_id]
-                del vs[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ks, q, memory_size)
+            ks = [ks[i] for i in keep]
+            vs = [vs[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ks))
-            p_m = [1.] * len(ks) + [0.] * lm
+            PL.append(len(ks))
             for _ in range(lm):
                 ks.append([0] * k_size)
                 vs.append(0)
-        y = np.zeros(output_size)
-        for a in answer:
-            y[output_idx[a]] = 1
-            #y[word_idx[a]] = 1
+        y = answer_id(answer, output_idx)
 
-        vm = np.zeros_like(y)
         # mask for all words in vocab not in the set of entities present in the values:
         # TODO this doesn't work for the no-ent setting
-        vs_voc = {output_idx[inv_w_idx[i]] for i in set(np.array(vs).flatten()) if i!=0 and inv_w_idx[i] in output_idx}
-        vm[list(vs_voc)] = 1.
+        vs_voc = window_output_ids(vs, output_ids)
+        vm = sorted(vs_voc)
 
         K.append(ks)
         V.append(vs)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        KM = np.clip(np.array(K), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(K), np.array(V), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(KM), np.array(QM)
+    K = np.array(K)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    KM = np.clip(K, 0., 1.)  # keys mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return K, np.array(V), Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, KM, QM
 
 
 def vectorize_data_clicr_kvatt(data, word_idx, output_size, output_idx, k_size, memory_size):
@@ -1635,7 +2164,7 @@ def vectorize_data_clicr_kvatt(data, word_idx, output_size, output_idx, k_size,
     If a story length < memory_size, the story will be padded with empty memories.
     Empty memories are 1-D arrays of length sentence_size filled with 0's.
 
-    The answer array is returned as a one-hot encoding.
+    The answers are returned as their output ids.
 
     vocab_mask marks which elements (=words/entities) in V are found in the particular document
 
@@ -1648,19 +2177,17 @@ def vectorize_data_clicr_kvatt(data, word_idx, output_size, output_idx, k_size,
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    KM = []  # keys mask
-    QM = []  # query mask
-    inv_w_idx = {v: k for k, v in word_idx.items()}
+    PL = []  # passage lengths
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for (k,v), query, answer, _, _, _ in data:
         lq = max(0, k_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ks = []
         for win in k:
             ls = max(0, k_size - len(win))
-            sent = [word_idx[w] for w in win] + [0] * ls
+            sent = [word_idx.get(w, unk) for w in win] + [0] * ls
             if len(sent) > k_size:  # can happen in test/val as sentence_size is calculated on train
                 sent = sent[:k_size]
             ks.append(sent)
@@ -1670,45 +2197,37 @@ def vectorize_data_clicr_kvatt(data, word_idx, output_size, output_idx, k_size,
         assert len(ks) == len(vs)
         if len(ks) > memory_size:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ks, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ks) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                del_id = ks.index(sent)
-                del ks[del_id]
-                del vs[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ks, q, memory_size)
+            ks = [ks[i] for i in keep]
+            vs = [vs[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ks))
-            p_m = [1.] * len(ks) + [0.] * lm
+            PL.append(len(ks))
             for _ in range(lm):
                 ks.append([0] * k_size)
                 vs.append(0)
-        y = np.zeros(output_size)
-        for a in answer:
-            y[output_idx[a]] = 1
-            #y[word_idx[a]] = 1
+        y = answer_id(answer, output_idx)
 
-        vm = np.zeros_like(y)
         # mask for all words in vocab not in the set of entities present in the values:
-        vs_voc = set(np.array(vs).flatten())
-        vm[list(vs_voc)] = 1.
+        vm = np.unique(vs)
 
         K.append(ks)
         V.append(vs)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        KM = np.clip(np.array(K), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(K), np.array(V), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(KM), np.array(QM)
+    K = np.array(K)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    KM = np.clip(K, 0., 1.)  # keys mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return K, np.array(V), Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, KM, QM
 
 
 def vectorize_data_kvatt(data, word_idx, output_size, output_idx, k_size, memory_size):
@@ -1722,7 +2241,7 @@ def vectorize_data_kvatt(data, word_idx, output_size, output_idx, k_size, memory
     If a story length < memory_size, the story will be padded with empty memories.
     Empty memories are 1-D arrays of length sentence_size filled with 0's.
 
-    The answer array is returned as a one-hot encoding.
+    The answers are returned as their output ids.
 
     vocab_mask marks which elements (=words/entities) in V are found in the particular document
 
@@ -1735,19 +2254,17 @@ def vectorize_data_kvatt(data, word_idx, output_size, output_idx, k_size, memory
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    KM = []  # keys mask
-    QM = []  # query mask
-    inv_w_idx = {v: k for k, v in word_idx.items()}
+    PL = []  # passage lengths
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for (k,v), query, answer in data:
         lq = max(0, k_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ks = []
         for win in k:
             ls = max(0, k_size - len(win))
-            sent = [word_idx[w] for w in win] + [0] * ls
+            sent = [word_idx.get(w, unk) for w in win] + [0] * ls
             if len(sent) > k_size:  # can happen in test/val as sentence_size is calculated on train
                 sent = sent[:k_size]
             ks.append(sent)
@@ -1757,45 +2274,37 @@ def vectorize_data_kvatt(data, word_idx, output_size, output_idx, k_size, memory
         assert len(ks) == len(vs)
         if len(ks) > memory_size:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ks, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ks) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                del_id = ks.index(sent)
-                del ks[del_id]
-                del vs[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ks, q, memory_size)
+            ks = [ks[i] for i in keep]
+            vs = [vs[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ks))
-            p_m = [1.] * len(ks) + [0.] * lm
+            PL.append(len(ks))
             for _ in range(lm):
                 ks.append([0] * k_size)
                 vs.append(0)
-        y = np.zeros(output_size)
-        for a in answer:
-            y[output_idx[a]] = 1
-            #y[word_idx[a]] = 1
+        y = answer_id(answer, output_idx)
 
-        vm = np.zeros_like(y)
         # mask for all words in vocab not in the set of entities present in the values:
-        vs_voc = set(np.array(vs).flatten())
-        vm[list(vs_voc)] = 1.
+        vm = np.unique(vs)
 
         K.append(ks)
         V.append(vs)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        KM = np.clip(np.array(K), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(K), np.array(V), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(KM), np.array(QM)
+    K = np.array(K)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    KM = np.clip(K, 0., 1.)  # keys mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return K, np.array(V), Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, KM, QM
 
 def vectorize_data_cbt_win(data, word_idx, output_size, output_idx, win_size, memory_size):
     '''
@@ -1804,60 +2313,60 @@ def vectorize_data_cbt_win(data, word_idx, output_size, output_idx, win_size, me
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    WM = []  # window mask
-    QM = []  # query mask
+    PL = []  # passage lengths
 
+    unk = word_idx["_UNK_"]  # for words cut from the vocabulary
     for wins, query, answer, _, _, _ in data:
         lq = max(0, win_size - len(query))
-        q = [word_idx[w] for w in query] + [0] * lq
+        q = [word_idx.get(w, unk) for w in query] + [0] * lq
 
         ws = []
         for win in wins:
             ls = max(0, win_size - len(win))
-            sent = [word_idx[w] for w in win] + [0] * ls  # TODO pad zeros where truly missing, not only at end
+            sent = [word_idx.get(w, unk) for w in win] + [0] * ls  # TODO pad zeros where truly missing, not only at end
             if len(sent) > win_size:  # can happen in test/val as sentence_size is calculated on train
                 sent = sent[:win_size]
             ws.append(sent)
 
         if len(ws) > memory_size:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ws, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ws) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                del_id = ws.index(sent)
-                del ws[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ws, q, memory_size)
+            ws = [ws[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ws))
-            p_m = [1.] * len(ws) + [0.] * lm
+            PL.append(len(ws))
             for _ in range(lm):
                 ws.append([0] * win_size)
-        y = np.zeros(output_size)
-        for a in answer:
-            y[word_idx[a]] = 1
-
-        vm = np.zeros_like(y)
+        y = answer_id(answer, word_idx)
 
         # vocab mask using only words in the passage
-        vs_voc = set(np.array(ws).flatten())
-        vm[list(vs_voc)] = 1.
+        vm = np.unique(ws)
 
         W.append(ws)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        WM = np.clip(np.array(W), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(W), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(WM), np.array(QM)
+    W = np.array(W)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    WM = np.clip(W, 0., 1.)  # window mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return W, Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, WM, QM
+
+
+def window_output_ids(ws, output_ids):
+    """
+    :param output_ids: WordLookup.output_ids
+    :return: the output ids of the words in ws, encoded sentences or windows (or values)
+    """
+    ids = output_ids[np.unique(np.asarray(ws, dtype=np.int64))]
+    return set(ids[ids >= 0].tolist())
 
 
 def vectorize_data_clicr_win(data, word_idx, output_size, output_idx, win_size, memory_size, top_k_cand=None):
@@ -1869,74 +2378,66 @@ def vectorize_data_clicr_win(data, word_idx, output_size, output_idx, win_size,
     Q = []
     A = []
     VM = []  # vocabulary mask
-    PM = []  # passage mask
-    WM = []  # window mask
-    QM = []  # query mask
-    inv_w_idx = {v: k for k, v in word_idx.items()}
+    PL = []  # passage lengths
+    output_ids = word_lookup(word_idx, output_idx).output_ids
 
     for wins, query, answer, _, _, _ in data:
         lq = max(0, win_size - len(query))
         q = [word_idx.get(w, word_idx["_UNK_"]) for w in query] + [0] * lq
 
-        ws = []
-        for win in wins:
-            ls = max(0, win_size - len(win))
-            sent = [word_idx.get(w, word_idx["_UNK_"]) for w in win] + [0] * ls  # TODO pad zeros where truly missing, not only at end
-            if len(sent) > win_size:  # can happen in test/val as sentence_size is calculated on train
-                sent = sent[:win_size]
-            ws.append(sent)
+        # encoded once per passage; copied, as ws is pruned and padded below
+        ws = list(wins.encoded(word_idx, win_size))
 
-        if len(ws) > memory_size:
+        pruned = len(ws) > memory_size
+        if pruned:
             # TODO this is currently problematic as it relies on simple word match
-            # Use Jaccard similarity to determine the most relevant sentences
-            q_words = (q)
-            least_like_q = sorted(ws, key=functools.cmp_to_key(
-                lambda x, y: jaccard_similarity_score((x), q_words) < jaccard_similarity_score((y), q_words)))[
-                           :len(ws) - memory_size]
-            for sent in least_like_q:
-                # Remove the first occurrence of sent. A list comprehension as in [sent for sent in ss if sent not in least_like_q]
-                # should not be used, as it would remove multiple occurrences of the same sentence, some of which might actually make the cutoff.
-                del_id = ws.index(sent)
-                del ws[del_id]
-            p_m = [1.] * memory_size
+            # keep the memories with the most word matches with the query, in their original order
+            keep = top_memories(ws, q, memory_size)
+            ws = [ws[i] for i in keep]
+            PL.append(memory_size)
         else:
             # pad to memory_size
             lm = max(0, memory_size - len(ws))
-            p_m = [1.] * len(ws) + [0.] * lm
+            PL.append(len(ws))
             for _ in range(lm):
                 ws.append([0] * win_size)
-        y = np.zeros(output_size)
-        for a in answer:
-            #y[word_idx.get(a, word_idx["_UNK_"])] = 1
-            y[output_idx[a]] = 1
+        y = answer_id(answer, output_idx)
 
-        vm = np.zeros_like(y)
 
         #vs_voc = set(np.array(ws).flatten())
         #TODO allow _UNK_ as the answer?--
         #vs_voc = {i for i in set(np.array(ws).flatten()) if i!=0 and (inv_w_idx[i].startswith("@entity") or inv_w_idx[i] == "_UNK_")}
-        vs_voc = {output_idx[inv_w_idx[i]] for i in set(np.array(ws).flatten()) if i != 0 and inv_w_idx[i] in output_idx}
+        if pruned:
+            vs_voc = window_output_ids(ws, output_ids)
+        else:  # the whole passage is kept, its mask is computed once per passage
+            vs_voc = set(wins.output_ids(word_idx, output_idx, win_size))
         if top_k_cand is not None:
             eff_top_k = top_k_cand
-            a = word_idx.get(a, word_idx["_UNK_"])
+            a = y  # output id, as are the ids in vs_voc
             if a in vs_voc:
                 vs_voc.remove(a)
                 eff_top_k = eff_top_k - 1
             if len(vs_voc) > eff_top_k:
                 vs_voc = np.random.choice(list(vs_voc), eff_top_k, replace=False)
                 vs_voc = np.concatenate((vs_voc, np.array([a])))
+            elif eff_top_k < top_k_cand:  # removed above, but there was nothing to cut
+                vs_voc.add(a)
 
-        vm[list(vs_voc)] = 1.
+        vm = sorted(vs_voc)
 
         W.append(ws)
         Q.append(q)
         A.append(y)
         VM.append(vm)
-        PM.append(p_m)
-        WM = np.clip(np.array(W), 0., 1.)
-        QM.append(np.clip(np.array(q), 0., 1.))
 
-    return np.array(W), np.array(Q), np.array(A), np.array(VM), np.array(PM), np.array(WM), np.array(QM)
+    W = np.array(W)
+    Q = np.array(Q)
+    # masks built once for the whole batch
+    PM = length_mask(PL, memory_size)  # passage mask
+    WM = np.clip(W, 0., 1.)  # window mask
+    QM = np.clip(Q, 0., 1.)  # query mask
+
+    return W, Q, np.array(A, dtype=np.int64), csr_rows(VM), PM, WM, QM
 
 
 def generate_batches(batches_tr, batches_v, batches_te, train, val, test):
@@ -1955,98 +2456,374 @@ def get_batch_from_batch_list(batches_tr, train):
     return train_batches
 
 
-def vectorized_batches(batches, data, word_idx, sentence_size, memory_size, output_size, output_idx, vectorizer=vectorize_data, shuffle=False):
-    # batches are of form : [(0,2), (2,4),...]
+class VectorizedSet(object):
+    """
+    A dataset vectorized once: the arrays a vectorizer returns, for all instances. Batches are taken from them by
+    instance ids. The vocabulary masks are (indptr, indices) pairs as in a CSR matrix, made dense only in the model
+    (see net_util.index_mask).
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def memory_lengths(self):
+        """
+        :return: the number of memories of each instance, without padding
+        """
+        pm = self.arrays[4 if len(self.arrays) == 7 else 5]
+        if pm is None:
+            return np.full(len(self), self.arrays[0].shape[1])
+        return pm.sum(axis=1).astype(np.int64)
+
+    def batch(self, ids, trim_words=True):
+        """
+        :param ids: instance ids
+        :param trim_words: also cut the word positions no memory or query of the batch uses. Not to be used with
+        position encoding, which depends on the padded length.
+        :return: the arrays of the instances, as returned by the vectorizer, padded only as far as the batch needs
+        """
+        return trim_batch([take_field(a, ids) for a in self.arrays], trim_words)
+
+
+def take_field(a, ids):
+    if a is None:
+        return None
+    if not isinstance(a, tuple):
+        return a[ids]
+    indptr, indices = a
+    starts = indptr[ids]
+    counts = indptr[ids + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return offsets, indices[np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])]
+
+
+def used_width(x):
+    """
+    :return: the length of the last axis up to its last nonzero entry in any row
+    """
+    nonzero = np.flatnonzero(x.reshape(-1, x.shape[-1]).any(axis=0))
+    return int(nonzero[-1]) + 1 if len(nonzero) else 1
+
+
+def trim_batch(arrays, trim_words=True):
+    """
+    Cut the memories beyond the longest passage of the batch and, with trim_words, the word positions beyond the
+    longest memory and query. Only padding is cut.
+    :param arrays: batch arrays as returned by a vectorizer, with 7 (stories) or 8 (keys and values) fields
+    """
+    if len(arrays) == 7:
+        memory_fields, pm, words, query = (0, 4, 5), 4, (0, 5), (1, 6)
+    else:
+        memory_fields, pm, words, query = (0, 1, 5, 6), 5, (0, 6), (2, 7)
+    if arrays[pm] is not None and len(arrays[pm]):
+        m = max(1, int(arrays[pm].sum(axis=1).max()))
+        for f in memory_fields:
+            arrays[f] = arrays[f][:, :m]
+    if trim_words and len(arrays[0]):
+        for fields in (words, query):
+            width = used_width(arrays[fields[0]])
+            for f in fields:
+                if arrays[f] is not None:
+                    arrays[f] = arrays[f][..., :width]
+    return arrays
+
+
+def bucket_batches(lengths, batch_size, shuffle=False, pool_size=50):
+    """
+    Group instances of similar memory length into batches, so that each batch is padded only as far as its longest
+    passage. As with the former contiguous batches, only full batches are made, of the first instances; at least
+    one instance is left out.
+    :param lengths: memory length of each instance, see VectorizedSet.memory_lengths
+    :param shuffle: shuffle the instances before sorting them by length within pools of pool_size batches, and
+    shuffle the batches. Otherwise all instances are sorted by length.
+    :return: list of arrays of instance ids
+    """
+    n = max(0, (len(lengths) - 1) // batch_size) * batch_size
+    ids = np.random.permutation(n) if shuffle else np.arange(n)
+    pool = pool_size * batch_size if shuffle else max(n, 1)
+    for s in range(0, n, pool):
+        ids[s:s + pool] = ids[s:s + pool][np.argsort(lengths[ids[s:s + pool]], kind="stable")]
+    batches = [ids[s:s + batch_size] for s in range(0, n, batch_size)]
     if shuffle:
         np.random.shuffle(batches)
-    for s_batch, e_batch in batches:
-        if vectorizer==vectorize_data:
-            dataS, dataQ, dataA, dataVM, dataPM, dataSM, dataQM = vectorizer(data[s_batch:e_batch], word_idx, sentence_size, memory_size)
+    return batches
+
+
+def concat_csr(parts):
+    """
+    :param parts: (indptr, indices) pairs
+    :return: the (indptr, indices) of their rows one after the other
+    """
+    offsets = np.cumsum([0] + [indptr[-1] for indptr, _ in parts[:-1]])
+    indptr = np.concatenate([[0]] + [indptr[1:] + o for (indptr, _), o in zip(parts, offsets)])
+    return indptr, np.concatenate([indices for _, indices in parts])
+
+
+def id_dtype(n_ids):
+    """
+    :return: the smallest integer dtype for ids below n_ids
+    """
+    return np.int16 if n_ids <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def compact(arrays, n_ids):
+    """
+    Store the vectorizer output in compact dtypes: the word and output ids in id_dtype(n_ids), the masks as bool.
+    The row offsets of the vocabulary masks stay int64. The tensors are made long and float per batch, on the
+    device (see batch_tensor).
+    """
+    dtype = id_dtype(n_ids)
+    compacted = []
+    for a in arrays:
+        if a is None:
+            compacted.append(None)
+        elif isinstance(a, tuple):  # vocabulary masks
+            compacted.append((a[0], a[1].astype(dtype)))
+        elif a.dtype.kind == "f":  # the masks are 0/1
+            compacted.append(a != 0)
+        else:
+            compacted.append(a.astype(dtype))
+    return compacted
+
+
+def vectorized_chunks(data, word_idx, sentence_size, memory_size, output_size, output_idx, vectorizer=vectorize_data,
+                      chunk_size=256):
+    n_ids = max(max(word_idx.values(), default=0) + 1, output_size or 0)
+    for s in range(0, len(data), chunk_size):
+        if vectorizer == vectorize_data:
+            arrays = vectorizer(data[s:s + chunk_size], word_idx, sentence_size, memory_size)
+        else:
+            arrays = vectorizer(data[s:s + chunk_size], word_idx, output_size, output_idx, sentence_size, memory_size)
+        yield compact(arrays, n_ids)
+
+
+def vectorize_set(data, word_idx, sentence_size, memory_size, output_size, output_idx, vectorizer=vectorize_data,
+                  chunk_size=256, shard_dir=None, name="data", log=None):
+    """
+    Vectorize a dataset once, chunk by chunk, instead of every batch in every epoch. The arrays are compacted (see
+    compact).
+    With shard_dir, the arrays are written there as shards (see write_shards) and memory-mapped, so that they are
+    shared through the page cache by all processes using them and need not fit in memory. Shards written before
+    for the same vectorizer, sizes, vocabulary and data are reused.
+    """
+    args = (data, word_idx, sentence_size, memory_size, output_size, output_idx, vectorizer, chunk_size)
+    if shard_dir is not None:
+        path = shard_path(shard_dir, name, *args[:-1])
+        if not os.path.exists(os.path.join(path, "header.json")):
+            write_shards(path, vectorized_chunks(*args))
+            if log is not None:
+                log.info("Wrote vectorized {} to {}".format(name, path))
+        elif log is not None:
+            log.info("Loading vectorized {} from {}".format(name, path))
+        return open_shards(path)
+    chunks = list(vectorized_chunks(*args))
+    if not chunks:
+        return VectorizedSet([np.zeros(0)])
+    arrays = []
+    for field in zip(*chunks):
+        if field[0] is None:
+            arrays.append(None)
+        elif isinstance(field[0], tuple):  # vocabulary masks
+            arrays.append(concat_csr(field))
+        else:
+            arrays.append(np.concatenate(field))
+
+    return VectorizedSet(arrays)
+
+
+def shard_path(shard_dir, name, data, word_idx, sentence_size, memory_size, output_size, output_idx, vectorizer):
+    """
+    The key combines the vectorizer and its sizes, the vocabularies and the instances.
+    """
+    key = hashlib.sha1()
+    key.update(json.dumps([vectorizer.__name__, sentence_size, memory_size, output_size, sorted(word_idx.items()),
+                           sorted(output_idx.items()) if output_idx is not None else None]).encode())
+    for inst in data:
+        key.update(json.dumps(inst, default=plain).encode())
+    key.update("{} {}".format(CACHE_VERSION, SHARD_VERSION).encode())
+    return os.path.join(shard_dir, "{}_{}".format(name, key.hexdigest()))
+
+
+def plain(o):
+    """
+    JSON stand-in for the objects in instances: passages as their windows, sets sorted.
+    """
+    if isinstance(o, (set, frozenset)):
+        return sorted(o, key=str)
+    if isinstance(o, (Passage, np.ndarray)):
+        return list(o)
+    if isinstance(o, np.generic):
+        return o.item()
+    return str(o)
+
+
+def write_shards(path, chunks):
+    """
+    Write the vectorized chunks as one raw array file per field, the chunks one after the other, and a
+    header.json giving the dtype and shape of each. The vocabulary masks are written as their indptr and indices.
+    The directory is written under a temporary name and renamed when complete.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    fields = None
+    files = {}
+    n = 0
+    offsets = {}
+    try:
+        for arrays in chunks:
+            if fields is None:
+                fields = [None if a is None else {"csr": True} if isinstance(a, tuple) else {} for a in arrays]
+            for f, a in enumerate(arrays):
+                if a is None:
+                    continue
+                if isinstance(a, tuple):  # indptr without its leading 0, shifted by the indices written before
+                    indptr, indices = a
+                    parts = [("indptr", indptr[1:] + offsets.get(f, 0)), ("indices", indices)]
+                    offsets[f] = offsets.get(f, 0) + int(indptr[-1])
+                else:
+                    parts = [("data", a)]
+                for part, x in parts:
+                    fn = "{}_{}.bin".format(f, part)
+                    if fn not in files:
+                        files[fn] = open(os.path.join(tmp_path, fn), "wb")
+                        fields[f][part] = {"file": fn, "dtype": x.dtype.str, "shape": [0] + list(x.shape[1:])}
+                    np.ascontiguousarray(x).tofile(files[fn])
+                    fields[f][part]["shape"][0] += len(x)
+            n += len(arrays[0])
+    finally:
+        for out in files.values():
+            out.close()
+    with open(os.path.join(tmp_path, "header.json"), "w") as out:
+        json.dump({"version": SHARD_VERSION, "n": n, "fields": fields or []}, out)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # written meanwhile by another process
+        shutil.rmtree(tmp_path)
+
+
+def open_shards(path):
+    """
+    :return: the VectorizedSet written by write_shards, its arrays memory-mapped read-only
+    """
+    with open(os.path.join(path, "header.json")) as in_f:
+        header = json.load(in_f)
+
+    def load(part):
+        shape = tuple(part["shape"])
+        if not np.prod(shape):  # empty files cannot be mapped
+            return np.zeros(shape, dtype=part["dtype"])
+        return np.memmap(os.path.join(path, part["file"]), dtype=part["dtype"], mode="r", shape=shape)
+
+    if not header["fields"]:
+        return VectorizedSet([np.zeros(0)])
+    arrays = []
+    for field in header["fields"]:
+        if field is None:
+            arrays.append(None)
+        elif field.get("csr"):
+            indptr = np.concatenate([[0], load(field["indptr"])]) if "indptr" in field else np.zeros(1, np.int64)
+            arrays.append((indptr, load(field["indices"])))
         else:
-            dataS, dataQ, dataA, dataVM, dataPM, dataSM, dataQM = vectorizer(data[s_batch:e_batch], word_idx, output_size, output_idx, sentence_size, memory_size)
+            arrays.append(load(field["data"]))
+    return VectorizedSet(arrays)
+
 
+def prefetched(make_batch, items, workers=0, depth=2):
+    """
+    Yield make_batch(item) for the items, in their order. With workers, the batches are made by that many threads,
+    up to depth batches ahead of the one in use, so that they are ready when the model needs them.
+    """
+    if workers <= 0:
+        for item in items:
+            yield make_batch(item)
+        return
+    items = iter(items)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque(pool.submit(make_batch, item) for item in islice(items, max(1, depth)))
+        try:
+            while pending:
+                batch = pending.popleft().result()
+                for item in islice(items, 1):
+                    pending.append(pool.submit(make_batch, item))
+                yield batch
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def vectorized_batches(batches, vset, trim_words=True, workers=0, depth=2):
+    # batches are arrays of instance ids, see bucket_batches
+    def make_batch(ids):
+        dataS, dataQ, dataA, dataVM, dataPM, dataSM, dataQM = vset.batch(ids, trim_words)
         dataA, dataQ, dataS, dataVM, dataPM, dataSM, dataQM = extract_tensors(dataA, dataQ, dataS, dataVM, dataPM, dataSM, dataQM)
 
-        yield [list(dataS),
-               list(dataQ),
-               list(dataA),
-               list(dataVM) if dataVM is not None else None,
-               list(dataPM) if dataPM is not None else None,
-               list(dataSM) if dataSM is not None else None,
-               list(dataQM) if dataQM is not None else None
-               ]
-
-def vectorized_batches_kv(batches, data, word_idx, k_size, memory_size, output_size, output_idx, vectorizer=vectorize_data_clicr_kv, shuffle=False):
-    # batches are of form : [(0,2), (2,4),...]
-    if shuffle:
-        np.random.shuffle(batches)
-    for s_batch, e_batch in batches:
-        dataK, dataV, dataQ, dataA, dataVM, dataPM, dataKM, dataQM = vectorizer(data[s_batch:e_batch], word_idx, output_size, output_idx, k_size, memory_size)
+        return [dataS, dataQ, dataA, dataVM, dataPM, dataSM, dataQM]
+
+    return prefetched(make_batch, batches, workers, depth)
+
+
+def vectorized_batches_kv(batches, vset, trim_words=True, workers=0, depth=2):
+    # batches are arrays of instance ids, see bucket_batches
+    def make_batch(ids):
+        dataK, dataV, dataQ, dataA, dataVM, dataPM, dataKM, dataQM = vset.batch(ids, trim_words)
         dataA, dataQ, dataK, dataV, dataVM, dataPM, dataKM, dataQM = extract_tensors_kv(dataA, dataQ, dataK, dataV, dataVM, dataPM, dataKM, dataQM)
 
-        yield [list(dataK),
-               list(dataV),
-               list(dataQ),
-               list(dataA),
-               list(dataVM) if dataVM is not None else None,
-               list(dataPM) if dataPM is not None else None,
-               list(dataKM) if dataKM is not None else None,
-               list(dataQM) if dataQM is not None else None
-               ]
+        return [dataK, dataV, dataQ, dataA, dataVM, dataPM, dataKM, dataQM]
 
+    return prefetched(make_batch, batches, workers, depth)
 
-def vectorized_batches_win(batches, data, word_idx, win_size, memory_size, output_size, output_idx, vectorizer=vectorize_data_cbt_win, shuffle=False):
-    # batches are of form : [(0,2), (2,4),...]
-    if shuffle:
-        np.random.shuffle(batches)
-    for s_batch, e_batch in batches:
-        dataW, dataQ, dataA, dataVM, dataPM, dataWM, dataQM = vectorizer(data[s_batch:e_batch], word_idx, output_size, output_idx, win_size, memory_size)
+
+def vectorized_batches_win(batches, vset, trim_words=True, workers=0, depth=2):
+    # batches are arrays of instance ids, see bucket_batches
+    def make_batch(ids):
+        dataW, dataQ, dataA, dataVM, dataPM, dataWM, dataQM = vset.batch(ids, trim_words)
         dataA, dataQ, dataW, dataVM, dataPM, dataWM, dataQM = extract_tensors_win(dataA, dataQ, dataW, dataVM, dataPM, dataWM, dataQM)
 
-        yield [list(dataW),
-               list(dataQ),
-               list(dataA),
-               list(dataVM) if dataVM is not None else None,
-               list(dataPM) if dataPM is not None else None,
-               list(dataWM) if dataWM is not None else None,
-               list(dataQM) if dataQM is not None else None
-               ]
+        return [dataW, dataQ, dataA, dataVM, dataPM, dataWM, dataQM]
+
+    return prefetched(make_batch, batches, workers, depth)
+
+
+def batch_tensor(a, tensor_type):
+    """
+    Move a compact batch array to the device as it is and convert it there.
+    """
+    return torch.from_numpy(np.ascontiguousarray(a)).to(tensor_device).type(tensor_type) if a is not None else None
 
 
 def extract_tensors(A, Q, S, VM, PM, SM, QM):
-    A = torch.from_numpy(A).type(long_tensor_type)
-    S = torch.from_numpy(S).type(float_tensor_type)
-    Q = np.expand_dims(Q, 1)
-    Q = torch.from_numpy(Q).type(long_tensor_type)
-    VM = torch.from_numpy(VM).type(float_tensor_type) if VM is not None else None
-    PM = torch.from_numpy(PM).type(float_tensor_type) if PM is not None else None
-    SM = torch.from_numpy(SM).type(float_tensor_type) if SM is not None else None
-    QM = torch.from_numpy(QM).type(float_tensor_type) if QM is not None else None
+    A = batch_tensor(A, long_tensor_type)
+    S = batch_tensor(S, long_tensor_type)
+    Q = batch_tensor(np.expand_dims(Q, 1), long_tensor_type)
+    VM = tuple(batch_tensor(a, long_tensor_type) for a in VM) if VM is not None else None
+    PM = batch_tensor(PM, float_tensor_type)
+    SM = batch_tensor(SM, float_tensor_type)
+    QM = batch_tensor(QM, float_tensor_type)
     return A, Q, S, VM, PM, SM, QM
 
 
 def extract_tensors_kv(A, Q, K, V, VM, PM, KM, QM):
-    A = torch.from_numpy(A).type(long_tensor_type)
-    K = torch.from_numpy(K).type(long_tensor_type)
-    V = torch.from_numpy(V).type(long_tensor_type)
-    Q = np.expand_dims(Q, 1)
-    Q = torch.from_numpy(Q).type(long_tensor_type)
-    VM = torch.from_numpy(VM).type(float_tensor_type) if VM is not None else None
-    PM = torch.from_numpy(PM).type(float_tensor_type) if PM is not None else None
-    KM = torch.from_numpy(KM).type(float_tensor_type) if KM is not None else None
-    QM = torch.from_numpy(QM).type(float_tensor_type) if QM is not None else None
+    A = batch_tensor(A, long_tensor_type)
+    K = batch_tensor(K, long_tensor_type)
+    V = batch_tensor(V, long_tensor_type)
+    Q = batch_tensor(np.expand_dims(Q, 1), long_tensor_type)
+    VM = tuple(batch_tensor(a, long_tensor_type) for a in VM) if VM is not None else None
+    PM = batch_tensor(PM, float_tensor_type)
+    KM = batch_tensor(KM, float_tensor_type)
+    QM = batch_tensor(QM, float_tensor_type)
     return A, Q, K, V, VM, PM, KM, QM
 
 
 def extract_tensors_win(A, Q, W, VM, PM, WM, QM):
-    A = torch.from_numpy(A).type(long_tensor_type)
-    W = torch.from_numpy(W).type(long_tensor_type)
-    Q = np.expand_dims(Q, 1)
-    Q = torch.from_numpy(Q).type(long_tensor_type)
-    VM = torch.from_numpy(VM).type(float_tensor_type) if VM is not None else None
-    PM = torch.from_numpy(PM).type(float_tensor_type) if PM is not None else None
-    WM = torch.from_numpy(WM).type(float_tensor_type) if WM is not None else None
-    QM = torch.from_numpy(QM).type(float_tensor_type) if QM is not None else None
+    A = batch_tensor(A, long_tensor_type)
+    W = batch_tensor(W, long_tensor_type)
+    Q = batch_tensor(np.expand_dims(Q, 1), long_tensor_type)
+    VM = tuple(batch_tensor(a, long_tensor_type) for a in VM) if VM is not None else None
+    PM = batch_tensor(PM, float_tensor_type)
+    WM = batch_tensor(WM, float_tensor_type)
+    QM = batch_tensor(QM, float_tensor_type)
     return A, Q, W, VM, PM, WM, QM
 
 
@@ -2068,12 +2845,14 @@ def construct_s_q_a_batch(batches, batched_objects, S, Q, A):
 def process_eval_data(data_dir, task_num, word_idx, sentence_size, vocab_size, log, memory_size=50, batch_size=2,
                       test_size=.1, debug=True, joint_training=0):
     random_state = None
-    data, test, vocab = load_data(data_dir, joint_training, task_num)
+    data, _, test, vocab = load_data(data_dir, joint_training, task_num)
 
     if (joint_training == 0):
-        memory_size, sentence_size, vocab_size, word_idx = calculate_parameter_values(data=data, debug=debug,
-                                                                                      memory_size=memory_size,
-                                                                                      vocab=vocab)
+        stats = collect_stats(data)
+        memory_size, vocab_size, word_idx, _, _ = calculate_parameter_values(stats, debug=debug,
+                                                                             memory_size=memory_size,
+                                                                             vocab=vocab, log=log)
+        sentence_size = max(stats.query_size, stats.sentence_size)  # for the position
     train_set, train_batches, val_set, val_batches, test_set, test_batches = \
         vectorize_task_data(batch_size, data, debug, memory_size, random_state,
                             sentence_size, test, test_size, word_idx, log)
@@ -2082,23 +2861,15 @@ def process_eval_data(data_dir, task_num, word_idx, sentence_size, vocab_size, l
            sentence_size, vocab_size, memory_size, word_idx
 
 
-def get_position_encoding(batch_size, sentence_size, embedding_size):
+def position_encoding(sentence_size, embedding_size):
     '''
-    Position Encoding 
+    Position Encoding: sentence_size*embedding_size weights for the word embeddings, to be broadcast over a batch
     '''
-    encoding = np.ones((embedding_size, sentence_size), dtype=np.float32)
     ls = sentence_size + 1
     le = embedding_size + 1
-    for i in range(1, le):
-        for j in range(1, ls):
-            encoding[i - 1, j - 1] = (i - (le - 1) / 2) * (j - (ls - 1) / 2)
+    encoding = np.outer(np.arange(1, le) - (le - 1) / 2, np.arange(1, ls) - (ls - 1) / 2).astype(np.float32)
     encoding = 1 + 4 * encoding / embedding_size / sentence_size
-    enc_vec = torch.from_numpy(np.transpose(encoding)).type(float_tensor_type)
-    lis = []
-    for _ in range(batch_size):
-        lis.append(enc_vec)
-    enc_vec = Variable(torch.stack(lis))
-    return enc_vec
+    return np.ascontiguousarray(np.transpose(encoding))
 
 
 def weight_update(name, param):